@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Benchmark hashing functions with different file sizes, block sizes and
+read methods, reporting throughput in MB/s. Files are generated in a
+temporary directory, which can be placed on the filesystem of interest.
+
+    python benchmarks/bench_hashing.py -s 1K -s 1M -s 4G -b 1M -b 16M
+
+Files are hashed repeatedly and the best time reported, so results are
+for files in the page cache unless they are larger than memory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+
+from yamanifest.hashing import (hash_many, supported_hashes, binhashes, read_methods, one_hundred_megabytes,
+                                _binhash_extent)
+from yamanifest.utils import parse_size
+
+def make_file(path, size, chunksize=64*1024*1024):
+    """
+    Write size bytes of random data to path
+    """
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining > 0:
+            nbytes = min(chunksize, remaining)
+            file.write(os.urandom(nbytes))
+            remaining -= nbytes
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024.
+    return '{:g}{}'.format(size, unit)
+
+def bench(path, size, hashfns, blocksizes, methods, repeat):
+    print('{} file'.format(format_size(size)))
+    print('  {:<16} {:<5} {:>9} {:>10} {:>10}'.format('hash', 'read', 'blocksize', 'time', 'MB/s'))
+    for fn in hashfns:
+        # Binhashes only read the start of large files
+        nbytes = _binhash_extent(size, one_hundred_megabytes) if fn in binhashes else size
+        for method in methods:
+            for blocksize in blocksizes:
+                elapsed = timeit(lambda: hash_many(path, [fn], method=method, blocksize=blocksize), repeat)
+                print('  {:<16} {:<5} {:>9} {:9.4f}s {:10.1f}'.format(
+                    fn, method, 'auto' if blocksize is None else format_size(blocksize),
+                    elapsed, nbytes / elapsed / 1e6 if elapsed > 0 else float('inf')))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hashing functions and read strategies")
+    parser.add_argument("-s", "--size", type=parse_size, action='append', help="File size, e.g. 1K, 100M, 4G")
+    parser.add_argument("-b", "--blocksize", type=parse_size, action='append',
+                        help="Block size to read files with (default is determined from the filesystem)")
+    parser.add_argument("-m", "--read-method", choices=read_methods, action='append', help="Read method (default is all)")
+    parser.add_argument("--hash", choices=supported_hashes, action='append', help="Hash function (default is all)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of repeats, best time is reported")
+    parser.add_argument("-d", "--dir", help="Directory in which to create test files")
+    args = parser.parse_args()
+
+    sizes = args.size or [1024, 1024*1024, 100*1024*1024, 1024*1024*1024]
+    blocksizes = args.blocksize or [None]
+    methods = args.read_method or read_methods
+    hashfns = args.hash or supported_hashes
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        for size in sizes:
+            path = os.path.join(tmpdir, 'file{}'.format(size))
+            make_file(path, size)
+            bench(path, size, hashfns, blocksizes, methods, args.repeat)
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()
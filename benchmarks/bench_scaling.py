@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Measure how Manifest operations scale with the number of entries, using
+synthetic trees of many small files and a few large ones. For each scale
+the wall time, peak memory allocated by python (tracemalloc) and growth in
+peak resident set size are reported for add, check, dump, load, update,
+update_matching_hashes and equals. For add and check the time spent in
+hashing tasks is also reported, to show the overhead of the worker pool.
+
+    python benchmarks/bench_scaling.py -n 1000 -n 100000 --large 2 --large-size 1G
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from yamanifest import manifest as mf
+from yamanifest.stats import HashStats
+from yamanifest.utils import parse_size
+
+def make_tree(root, nfiles, nlarge, largesize, perdir=1000):
+    """
+    Create nfiles small files in directories of perdir files, and nlarge
+    files of largesize bytes. Return list of file paths
+    """
+    filepaths = []
+    for i in range(nfiles):
+        dirname = os.path.join(root, 'dir{}'.format(i // perdir))
+        if i % perdir == 0:
+            os.makedirs(dirname)
+        filepath = os.path.join(dirname, 'file{}'.format(i))
+        with open(filepath, 'wb') as file:
+            file.write(os.urandom(64 + i % 1024))
+        filepaths.append(filepath)
+    for i in range(nlarge):
+        filepath = os.path.join(root, 'large{}'.format(i))
+        with open(filepath, 'wb') as file:
+            remaining = largesize
+            while remaining > 0:
+                nbytes = min(remaining, 64*1024*1024)
+                file.write(os.urandom(nbytes))
+                remaining -= nbytes
+        filepaths.append(filepath)
+    return filepaths
+
+def maxrss():
+    """
+    Return peak resident set size of this process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def measure(name, func, stats=None):
+    """
+    Run func, printing wall time and memory use, and the time spent in
+    hashing tasks if stats is given
+    """
+    rss = maxrss()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    line = '  {:<24} {:9.3f}s {:10.1f} MB {:10.1f} MB'.format(name, elapsed, peak/1e6, (maxrss() - rss)/1e6)
+    if stats is not None:
+        hashing = sum(result.elapsed for result in stats.results)
+        line += ' {:9.3f}s {:9.3f}s'.format(hashing, elapsed - hashing)
+        del stats.results[:]
+    print(line)
+    return result
+
+def bench(nfiles, args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        start = time.perf_counter()
+        filepaths = make_tree(os.path.join(tmpdir, 'tree'), nfiles, args.large, args.large_size)
+        print('{} files ({} large), created in {:.1f}s'.format(len(filepaths), args.large, time.perf_counter() - start))
+        print('  {:<24} {:>10} {:>13} {:>13} {:>10} {:>10}'.format(
+            'operation', 'wall', 'tracemalloc', 'maxrss', 'hashing', 'overhead'))
+
+        stats = HashStats()
+        mfpath = os.path.join(tmpdir, 'manifest.yaml')
+        with mf.Manifest(mfpath, backend=args.backend, callbacks=[stats]) as mf1:
+            measure('add', lambda: mf1.add(filepaths, args.hashes), stats)
+            measure('check', lambda: mf1.check(), stats)
+            measure('dump', mf1.dump)
+
+        mf2 = mf.Manifest(mfpath)
+        measure('load', mf2.load)
+        mf3 = mf.Manifest(None)
+        measure('update', lambda: mf3.update(mf2))
+        measure('equals', lambda: mf3.equals(mf2))
+
+        # Manifest with only the cheapest hash, gaining the others from mf2
+        mf4 = mf.Manifest(None)
+        for filepath in mf2:
+            mf4.data[filepath] = { 'fullpath': mf2.data[filepath]['fullpath'],
+                                   'hashes': { args.hashes[0]: mf2.data[filepath]['hashes'][args.hashes[0]] } }
+        measure('update_matching_hashes', lambda: mf4.update_matching_hashes(mf2))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scaling of manifest operations")
+    parser.add_argument("-n", "--files", type=int, action='append', help="Number of small files")
+    parser.add_argument("--large", type=int, default=2, help="Number of large files")
+    parser.add_argument("--large-size", type=parse_size, default=parse_size('100M'), help="Size of large files")
+    parser.add_argument("-s", "--hashes", action='append', help="Hashing functions (default is binhash and md5)")
+    parser.add_argument("--backend", choices=mf.backends, default='auto', help="Backend for hashing")
+    parser.add_argument("-d", "--dir", help="Directory in which to create the file trees")
+    args = parser.parse_args()
+
+    if args.hashes is None:
+        args.hashes = ['binhash', 'md5']
+
+    for nfiles in args.files or [1000, 10000, 100000]:
+        bench(nfiles, args)
+
+if __name__ == "__main__":
+    main()
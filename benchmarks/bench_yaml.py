@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Benchmark loading and dumping manifests with the pure python and libyaml
+YAML implementations, and the binary format.
+
+    python benchmarks/bench_yaml.py -n 10000 -n 100000
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+import yaml
+
+from yamanifest import manifest as mf
+from yamanifest import binformat
+
+def make_data(nentries, seed=0):
+    """
+    Return manifest data with nentries entries resembling a real manifest
+    """
+    rand = random.Random(seed)
+    chars = string.ascii_lowercase + string.digits + '_-'
+    data = {}
+    for i in range(nentries):
+        dirname = '/'.join(''.join(rand.choice(chars) for _ in range(8)) for _ in range(rand.randint(1, 6)))
+        filepath = '{}/file{}.nc'.format(dirname, i)
+        data[filepath] = {
+            'fullpath': '/g/data/project/experiment/' + filepath,
+            'hashes': {
+                'binhash': '%032x' % rand.getrandbits(128),
+                'md5': '%032x' % rand.getrandbits(128),
+            },
+            'stat': {
+                'size': rand.getrandbits(32),
+                'mtime_ns': rand.getrandbits(60),
+                'inode': rand.getrandbits(32),
+                'device': 64769,
+            },
+        }
+    return data
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench(nentries, repeat):
+    header = {'format': 'yamanifest', 'version': 1.0}
+    data = make_data(nentries)
+    text = mf.dump_yaml(header, data)
+    assert text == yaml.dump_all([header, data], default_flow_style=False)
+
+    results = [
+        ('dump', 'python', timeit(lambda: yaml.dump_all([header, data], Dumper=yaml.SafeDumper, default_flow_style=False), repeat)),
+        ('dump', 'yamanifest', timeit(lambda: mf.dump_yaml(header, data), repeat)),
+        ('load', 'python', timeit(lambda: list(yaml.load_all(text, Loader=yaml.SafeLoader)), repeat)),
+        ('load', 'yamanifest', timeit(lambda: list(yaml.load_all(text, Loader=mf.SafeLoader)), repeat)),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mf1 = mf.Manifest(os.path.join(tmpdir, 'manifest.yaml'))
+        mf1.data = data
+        results.append(('Manifest.dump', 'yamanifest', timeit(mf1.dump, repeat)))
+        results.append(('Manifest.load', 'yamanifest', timeit(mf1.load, repeat)))
+        mf2 = mf.Manifest(os.path.join(tmpdir, 'manifest' + binformat.extension))
+        mf2.data = data
+        results.append(('Manifest.dump', 'binary', timeit(mf2.dump, repeat)))
+        results.append(('Manifest.load', 'binary', timeit(mf2.load, repeat)))
+        binsize = os.path.getsize(mf2.path)
+
+    print('{} entries, {:.1f} MB YAML, {:.1f} MB binary'.format(nentries, len(text)/1e6, binsize/1e6))
+    python = {}
+    for operation, implementation, elapsed in results:
+        speedup = ''
+        if implementation == 'python' or operation.startswith('Manifest') and implementation == 'yamanifest':
+            python[operation] = elapsed
+        elif operation in python:
+            speedup = '{:.1f}x'.format(python[operation]/elapsed)
+        print('  {:<14} {:<11} {:8.3f}s {:>6}'.format(operation, implementation, elapsed, speedup))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark manifest YAML load and dump")
+    parser.add_argument("-n", "--entries", type=int, action='append', help="Number of manifest entries")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of repeats, best time is reported")
+    args = parser.parse_args()
+
+    print('libyaml available: {}'.format(mf.CSafeDumper is not None))
+    for nentries in args.entries or [1000, 10000, 100000]:
+        bench(nentries, args.repeat)
+
+if __name__ == "__main__":
+    main()
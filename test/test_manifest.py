@@ -22,6 +22,7 @@ import shutil
 import sys
 
 import pytest
+import yaml
 
 print("Version: {}".format(sys.version))
 
@@ -70,10 +71,11 @@ def setup_module(module):
 def teardown_module(module):
     if verbose: print ("teardown_module   module:%s" % module.__name__)
     shutil.rmtree(os.path.join('test','testfiles_copy'),ignore_errors=True)
-    try:
-        os.remove(os.path.join('test','testfiles','mf1.yaml'))
-    except:
-        pass
+    for path in [os.path.join('test','testfiles','mf1.yaml'), 'mf1.yaml']:
+        try:
+            os.remove(path)
+        except:
+            pass
 
 def test_manifest_read_write():
 
@@ -440,6 +442,32 @@ def test_update():
         
     assert(mf4.equals(mf1))
 
+def test_update_rewrite():
+
+    files = [os.path.join('test',f) for f in ['file1','file2']]
+
+    mf1 = mf.Manifest(None)
+    mf1.add(files, ['md5'])
+    md5 = mf1.get(files[0], 'md5')
+
+    # Entries are not shared, so changes to either do not affect the other
+    mf2 = mf.Manifest(None)
+    mf2.update(mf1)
+    mf2.data[files[0]]['hashes']['md5'] = 'changed'
+    assert(mf1.get(files[0], 'md5') == md5)
+    assert(mf2.find('md5', 'changed') == files[0])
+
+    # Entries are kept when newpath does not change the filepath
+    mf3 = mf.Manifest(None)
+    mf3.update(mf1, newpath='test')
+    assert(mf3.equals(mf1))
+
+    mf4 = mf.Manifest(None)
+    mf4.update(mf1, rewrite=lambda filepath: filepath.replace('test', 'archive', 1))
+    assert(sorted(mf4) == [os.path.join('archive',f) for f in ['file1','file2']])
+    assert(mf4.find('md5', md5) == os.path.join('archive','file1'))
+    assert(mf4.equals(mf1, paths=True) is False and sorted(mf1) == files)
+
 def test_specify_fullpath():
 
     mf1 = mf.Manifest('mf1.yaml')
@@ -503,3 +531,1054 @@ def test_binhash_nomtime():
         assert(not mf1.equals(mf2))
         assert(not mf1.equals(mf3))
         assert(mf2.equals(mf4))
+
+def test_trust_stat(tmp_path):
+
+    filepath = str(tmp_path / 'file1')
+    shutil.copy(os.path.join('test','file1'), filepath)
+
+    mf1 = mf.Manifest(str(tmp_path / 'mf1.yaml'))
+    mf1.add(filepath, ['md5'])
+
+    assert(mf1.data[filepath]['stat'] == mf.file_stat(filepath))
+    assert(mf1.check(trust_stat=True))
+
+    # Corrupt the stored hash. An unchanged stat means the file is not
+    # rehashed, so only the full check notices
+    mf1.data[filepath]['hashes']['md5'] = 'bogus'
+    assert(mf1.check(trust_stat=True))
+    assert(not mf1.check())
+
+    # Changing the mtime forces a rehash
+    st = os.stat(filepath)
+    os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert(not mf1.check(trust_stat=True))
+
+    # Stat is preserved through dump and load
+    mf1.add(filepath, ['md5'], force=True)
+    mf1.dump()
+    mf2 = mf.Manifest(str(tmp_path / 'mf1.yaml')).load()
+    assert(mf2.stat_matches(filepath))
+    assert(yamf.main_parse_args(["check","-n",str(tmp_path / 'mf1.yaml'),"--trust-stat"]))
+
+    # Adding a new hash to a changed file cannot vouch for the stale hashes
+    os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 2000000000))
+    mf2.add(filepath, ['sha1'])
+    assert('stat' not in mf2.data[filepath])
+
+def test_hash_cache(tmp_path):
+
+    from yamanifest.cache import HashCache
+
+    filepath = str(tmp_path / 'file1')
+    shutil.copy(os.path.join('test','file1'), filepath)
+    cachepath = str(tmp_path / 'cache.db')
+
+    mf1 = mf.Manifest(None, cache=cachepath)
+    mf1.add(filepath, ['md5','sha1'])
+    assert(len(mf1.cache) == 2)
+
+    # Plant a value in the cache to show it is used instead of hashing
+    stat = mf.file_stat(filepath)
+    mf1.cache.put(stat, filepath, 'md5', 'cached')
+    mf2 = mf.Manifest(None, cache=HashCache(cachepath))
+    mf2.add(filepath, ['md5'])
+    assert(mf2.get(filepath, 'md5') == 'cached')
+
+    # A changed file is a cache miss
+    st = os.stat(filepath)
+    os.utime(filepath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    mf3 = mf.Manifest(None, cache=cachepath)
+    mf3.add(filepath, ['md5'])
+    assert(mf3.get(filepath, 'md5') == mf1.get(filepath, 'md5'))
+
+    # Least recently used values are evicted
+    cache = HashCache(str(tmp_path / 'small.db'), maxentries=2)
+    cache.put(stat, filepath, 'md5', 'a')
+    cache.put(stat, filepath, 'sha1', 'b')
+    assert(cache.get(stat, filepath, 'md5') == 'a')
+    cache.put(stat, filepath, 'sha256', 'c')
+    assert(len(cache) == 2)
+    assert(cache.get(stat, filepath, 'sha1') is None)
+    assert(cache.get(stat, filepath, 'md5') == 'a')
+
+    # Cache can be enabled from yamf
+    mfpath = str(tmp_path / 'mf.yaml')
+    yamf.main_parse_args(["add","-n",mfpath,"-s","md5","--cache",str(tmp_path / 'yamf.db'),filepath])
+    assert(len(HashCache(str(tmp_path / 'yamf.db'))) == 1)
+    assert(yamf.main_parse_args(["check","-n",mfpath,"--cache",str(tmp_path / 'yamf.db')]))
+
+def _reference_hash(path, hashfn):
+    # Reference implementation of the original hashing code, for checking
+    # hash values are unchanged by alterations to how files are read
+    import hashlib, io, xxhash
+    chunksize = 8192
+    if hashfn.startswith('binhash'):
+        size = 104857600
+        m = xxhash.xxh3_64() if hashfn == 'binhash-xxh' else hashlib.new('md5')
+        hashstring = os.path.basename(path) + str(os.path.getsize(path))
+        if hashfn != 'binhash-nomtime':
+            hashstring += str(os.path.getmtime(path))
+        m.update(hashstring.encode())
+        tot = 0
+        with io.open(path, mode="rb") as fd:
+            for chunk in iter(lambda: fd.read(chunksize), b''):
+                tot += len(chunk)
+                if tot >= size:
+                    break
+                m.update(chunk)
+        return m.hexdigest()
+    m = hashlib.new(hashfn)
+    with io.open(path, mode="rb") as fd:
+        for chunk in iter(lambda: fd.read(chunksize), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+def test_hash_many():
+
+    from yamanifest.hashing import hash_many, supported_hashes, treehashes, tree_hash
+
+    with cd(os.path.join('test','testfiles_copy')):
+
+        for filepath in glob.glob('*.bin') + glob.glob('*.nc'):
+            for method in ['mmap', 'read']:
+                hashvals = hash_many(filepath, supported_hashes, method=method)
+                for fn in supported_hashes:
+                    if fn in treehashes:
+                        assert(hashvals[fn] == tree_hash(filepath))
+                    else:
+                        assert(hashvals[fn] == _reference_hash(filepath, fn))
+
+        # Unhashable paths return None for all hashes
+        assert(hash_many('.', ['md5','binhash']) == {'md5': None, 'binhash': None})
+
+        with pytest.raises(ValueError):
+            hash_many(filepath, ['md5'], method='bogus')
+
+    # Hash values do not depend on the block size
+    with cd(os.path.join('test','testfiles_copy')):
+        for filepath in ['25mb.bin'] + glob.glob('*.nc'):
+            for method in ['mmap', 'read']:
+                for blocksize in [4097, 65536, 4*1024*1024]:
+                    hashvals = hash_many(filepath, ['binhash','md5'], method=method, blocksize=blocksize)
+                    for fn in hashvals:
+                        assert(hashvals[fn] == _reference_hash(filepath, fn))
+
+    # Files which cannot be memory mapped fall back to reading
+    emptyfile = os.path.join('test','.empty')
+    assert(hash_many(emptyfile, ['md5'])['md5'] == _reference_hash(emptyfile, 'md5'))
+    if os.path.exists('/dev/null'):
+        assert(hash_many('/dev/null', ['md5'])['md5'] == _reference_hash(emptyfile, 'md5'))
+
+def test_reuse_pool():
+
+    import multiprocessing
+
+    files = [os.path.join('test',f) for f in ['file1','file2']]
+
+    with mf.Manifest(None, backend='process') as mf1:
+        mf1.add(files[0], ['md5'])
+        pool = mf1._pools['process']
+        mf1.add(files[1], ['md5'])
+        assert(mf1._pools['process'] is pool)
+        assert(mf1.check())
+        assert(mf1._pools['process'] is pool)
+    assert(len(mf1._pools) == 0)
+
+    # Pool is recreated if needed after close
+    assert(mf1.check())
+    mf1.close()
+
+    # Injected pool is used and not closed
+    with multiprocessing.Pool(2) as pool:
+        mf2 = mf.Manifest(None, pool=pool)
+        mf2.add(files, ['md5'])
+        mf2.close()
+        assert(mf2.check())
+        assert(len(mf2._pools) == 0)
+        assert(mf1.equals(mf2))
+
+def test_backends():
+
+    with cd(os.path.join('test','testfiles_copy')):
+
+        files = glob.glob('*.bin') + glob.glob('*.nc')
+
+        manifests = []
+        for backend in ['process', 'thread', 'serial']:
+            with mf.Manifest(None, backend=backend) as mf1:
+                mf1.add(files, ['binhash-xxh','md5'])
+                assert(mf1.check())
+                assert(list(mf1._pools) == [backend])
+                manifests.append(mf1)
+
+        for mf1 in manifests[1:]:
+            assert(mf1.equals(manifests[0]))
+
+        with pytest.raises(ValueError):
+            mf.Manifest(None, backend='bogus')
+
+        # Automatic choice depends on the amount of data to hash
+        mf1 = mf.Manifest(None, numproc=4)
+        mf1.add(files, ['md5'], fullpaths=files)
+        ncfiles = { f: ['md5'] for f in glob.glob('*.nc') }
+        assert(mf1._choose_backend(ncfiles) == 'serial')
+        binfiles = { f: ['md5'] for f in glob.glob('*.bin') }
+        assert(mf1._choose_backend(binfiles) == 'thread')
+        # Many small files
+        smallfiles = { 'file{}'.format(i): ['md5'] for i in range(1000) }
+        stats = { f: {'size': 100000} for f in smallfiles }
+        assert(mf1._choose_backend(smallfiles, stats) == 'process')
+
+        yamf.main_parse_args(["add","-n","mf11.yaml","--backend","thread"] + files)
+        assert(yamf.main_parse_args(["check","-n","mf11.yaml","--backend","thread"]))
+
+def test_cascade(tmp_path):
+
+    files = [os.path.join('test',f) for f in ['file1','file2']]
+
+    mf1 = mf.Manifest(str(tmp_path / 'mf1.yaml'))
+    mf1.add(files, ['sha256','binhash-xxh','md5'])
+
+    # Record the hashes that are calculated
+    calculated = []
+    iter_hashes = mf1.iter_hashes
+    def spy(filepaths, hashfns, *args):
+        calculated.extend(zip(filepaths, hashfns))
+        return iter_hashes(filepaths, hashfns, *args)
+    mf1.iter_hashes = spy
+
+    assert(mf1.check(cascade='first'))
+    assert(sorted(calculated) == [(f, 'binhash-xxh') for f in files])
+
+    del calculated[:]
+    assert(mf1.check(cascade='confirm'))
+    assert(sorted(calculated) == sorted([(f, fn) for f in files for fn in ['binhash-xxh', 'md5']]))
+
+    # A mismatch on the cheapest hash decides the file without escalating
+    del calculated[:]
+    mf1.data[files[0]]['hashes']['binhash-xxh'] = 'bogus'
+    hashvals = {}
+    assert(not mf1.check(cascade='confirm', hashvals=hashvals))
+    assert((files[0], 'md5') not in calculated)
+    assert(list(hashvals) == [files[0]])
+    assert(mf1.check(cascade='confirm', condition=any))
+
+    # Escalate if hash cannot be calculated
+    mf1.data[files[0]]['hashes']['binhash-xxh'] = mf1.data[files[1]]['hashes']['binhash-xxh']
+    mf1.data[files[0]]['fullpath'] = str(tmp_path)
+    del calculated[:]
+    assert(not mf1.check_file(files[0], cascade='first'))
+    assert(calculated == [(files[0], fn) for fn in ['binhash-xxh', 'md5', 'sha256']])
+
+    with pytest.raises(ValueError):
+        mf1.check(cascade='bogus')
+
+    mf1.iter_hashes = iter_hashes
+    mf1.data[files[0]]['fullpath'] = os.path.realpath(files[0])
+    mf1.add(files[0], 'binhash-xxh', force=True)
+    mf1.dump()
+    assert(yamf.main_parse_args(["check","-n",str(tmp_path / 'mf1.yaml'),"--cascade","confirm"]))
+
+def test_blocksize():
+
+    from yamanifest.hashing import auto_blocksize, min_blocksize
+    from yamanifest.utils import parse_size
+
+    assert(auto_blocksize(4096) == min_blocksize)
+    assert(auto_blocksize(4*1024*1024) == 4*1024*1024)
+    assert(auto_blocksize(3*1024*1024+1) == 3*1024*1024+1)
+    assert(auto_blocksize(1000000) == 2000000)
+    assert(auto_blocksize(None) == min_blocksize)
+
+    assert(parse_size('4M') == 4*1024*1024)
+    assert(parse_size('512k') == 512*1024)
+    assert(parse_size('1GiB') == 1024**3)
+    assert(parse_size('1000') == 1000)
+
+    with cd(os.path.join('test','testfiles_copy')):
+
+        files = glob.glob('*.nc')
+        mf1 = mf.Manifest(None)
+        mf1.add(files, ['binhash','md5'])
+        mf2 = mf.Manifest(None, blocksize=4096, read_method='mmap')
+        mf2.add(files, ['binhash','md5'])
+        assert(mf1.equals(mf2))
+
+        yamf.main_parse_args(["add","-n","mf12.yaml","-s","md5","--blocksize","64k","--read-method","mmap"] + files)
+        assert(yamf.main_parse_args(["check","-n","mf12.yaml","--blocksize","8M"]))
+
+def test_tree_hash(monkeypatch):
+
+    import xxhash
+    from yamanifest import hashing
+    from yamanifest.hashing import tree_hash, parse_tree_hash
+
+    blocksize = 1024*1024
+
+    with cd(os.path.join('test','testfiles_copy')):
+
+        filepath = '25mb.bin'
+
+        # Reference calculation
+        m = xxhash.xxh3_128()
+        m.update(str(os.path.getsize(filepath)).encode())
+        with open(filepath, 'rb') as fd:
+            for block in iter(lambda: fd.read(blocksize), b''):
+                m.update(xxhash.xxh3_128(block).digest())
+        reference = '{}:{}'.format(blocksize, m.hexdigest())
+
+        assert(tree_hash(filepath, blocksize, threads=1) == reference)
+        assert(tree_hash(filepath, blocksize, threads=4, readsize=65536) == reference)
+        assert(parse_tree_hash(reference) == (blocksize, reference.split(':')[1]))
+        assert(parse_tree_hash('bogus') is None)
+        assert(tree_hash(filepath, 2*blocksize) != reference)
+        assert(tree_hash(os.path.join('..','.empty')) != tree_hash(filepath))
+
+        mf1 = mf.Manifest(None, treeblocksize=blocksize)
+        mf1.add(filepath, ['xxh3-tree', 'md5'])
+        assert(mf1.get(filepath, 'xxh3-tree') == reference)
+
+        # Check uses the stored block size
+        mf2 = mf.Manifest(None)
+        mf2.update(mf1)
+        assert(mf2.check(hashfn='xxh3-tree'))
+        mf2.add(filepath, 'xxh3-tree', force=True)
+        assert(mf2.get(filepath, 'xxh3-tree') == reference)
+
+        mf3 = mf.Manifest(None)
+        mf3.add(filepath, 'xxh3-tree')
+        assert(parse_tree_hash(mf3.get(filepath, 'xxh3-tree'))[0] == 64*1024*1024)
+
+        # The CPUs are divided between files hashed at the same time
+        threads = []
+        def spy(path, blocksize=None, threads_=None, readsize=None):
+            threads.append(threads_)
+            return tree_hash(path, blocksize, threads_, readsize)
+        monkeypatch.setattr(hashing, 'tree_hash', spy)
+        ncpus = os.cpu_count() or 1
+        mf.Manifest(None, backend='thread', numproc=2).add(['25mb.bin', '100mb.bin'], 'xxh3-tree')
+        assert(threads == [max(1, ncpus // 2)] * 2)
+        del threads[:]
+        mf.Manifest(None, backend='thread', numproc=2).add(['25mb.bin'], 'xxh3-tree')
+        mf.Manifest(None, backend='serial').add(['25mb.bin', '100mb.bin'], 'xxh3-tree')
+        mf.Manifest(None, backend='thread', treethreads=3).add(['25mb.bin', '100mb.bin'], 'xxh3-tree')
+        assert(threads == [ncpus] * 3 + [3] * 2)
+
+def test_dump_yaml_compatible(tmp_path):
+
+    import random
+    import string
+    import yaml
+
+    # Output must be identical to the pure python dumper, including keys
+    # with lengths where libyaml differs and strings which are double quoted
+    rand = random.Random(0)
+    chars = string.ascii_letters + ' /._-:#\'"\té'
+    data = {}
+    for i in range(500):
+        key = ''.join(rand.choice(chars) for _ in range(rand.randint(1, 200)))
+        data[key] = {'fullpath': ''.join(rand.choice(chars) for _ in range(rand.randint(1, 300))),
+                     'hashes': {'md5': '%032x' % rand.getrandbits(128)},
+                     'stat': {'size': i}}
+    for length in range(120, 131):
+        data['a'*length] = {'fullpath': 'b'*length, 'hashes': {'md5': 'c'}}
+
+    mf1 = mf.Manifest(str(tmp_path / 'mf1.yaml'))
+    mf1.data = data
+    mf1.dump()
+
+    with open(str(tmp_path / 'mf1.yaml')) as file:
+        assert(file.read() == yaml.dump_all([mf1.header, data], default_flow_style=False))
+
+    mf2 = mf.Manifest(str(tmp_path / 'mf1.yaml')).load()
+    assert(mf2.data == data)
+
+    assert(mf.dump_yaml(mf1.header, {}) == yaml.dump_all([mf1.header, {}], default_flow_style=False))
+
+def test_binary_format(tmp_path):
+
+    from yamanifest import binformat
+
+    with cd(os.path.join('test','testfiles_copy')):
+        mf1 = mf.Manifest(str(tmp_path / 'mf1.yamfb'))
+        mf1.add(glob.glob('*.nc') + glob.glob('*.bin'), ['binhash','md5','xxh3-tree'])
+        mf1.add(['../file1', '../otherfile'], ['md5','sha1'])
+
+    # Unusual values are preserved
+    mf1.data['odd/path'] = {'fullpath': 'nodir', 'hashes': {'md5': 0, 'binhash': 'ABC', 'sha1': ' '},
+                            'stat': {'size': 1}, 'extra': [1, 2]}
+    mf1.data['nohashes'] = {'fullpath': 'é/f'}
+    mf1.dump()
+
+    assert(binformat.is_binary(str(tmp_path / 'mf1.yamfb')))
+    mf2 = mf.Manifest(str(tmp_path / 'mf1.yamfb')).load()
+    assert(mf2.fileformat == 'binary')
+    assert(mf2.header == mf1.header)
+    assert(mf2.data == mf1.data)
+    del mf1.data['odd/path'], mf1.data['nohashes']
+
+    # Full paths ending with the filepath are stored as a prefix
+    data = {'a/b': {'fullpath': '/x/a/b', 'hashes': {'md5': 'ab'}}}
+    buf = binformat.dumps(mf1.header, data)
+    assert(len(buf) < len(binformat.dumps(mf1.header, {'a/b': {'fullpath': '/x/a/c', 'hashes': {'md5': 'ab'}}})))
+    assert(binformat.loads(buf) == (mf1.header, data))
+
+    # Version 1 files are still read
+    data = {'a/b': {'fullpath': '/x/c', 'hashes': {'md5': 'ab'}}}
+    buf = b'YAMFBIN\x01' + binformat.dumps(mf1.header, data)[len(binformat.MAGIC):]
+    assert(binformat.loads(buf) == (mf1.header, data))
+    (tmp_path / 'v1.yamfb').write_bytes(buf)
+    assert(mf.Manifest(str(tmp_path / 'v1.yamfb')).load().data == data)
+
+    # Format is detected from file contents on load
+    assert(yamf.main_parse_args(["convert", str(tmp_path / 'mf1.yamfb'), str(tmp_path / 'mf2.yaml')]))
+    assert(not binformat.is_binary(str(tmp_path / 'mf2.yaml')))
+    mf3 = mf.Manifest(str(tmp_path / 'mf2.yaml')).load()
+    assert(mf3.data == mf2.data)
+    assert(yamf.main_parse_args(["convert", "--to", "binary", str(tmp_path / 'mf2.yaml'), str(tmp_path / 'mf3.yaml')]))
+    mf4 = mf.Manifest(str(tmp_path / 'mf3.yaml')).load()
+    assert(mf4.fileformat == 'binary')
+    assert(mf4.data == mf2.data)
+
+    del mf4.data['odd/path'], mf4.data['nohashes']
+    mf4.dump()
+    assert(mf4.check())
+    assert(yamf.main_parse_args(["check","-n",str(tmp_path / 'mf3.yaml')]))
+
+    with pytest.raises(ValueError):
+        mf.Manifest(None, fileformat='bogus')
+
+def test_lazy_load(tmp_path):
+
+    from yamanifest.lazy import LazyData, index_extension
+
+    mfpath = str(tmp_path / 'mf1.yaml')
+    files = [os.path.join('test',f) for f in ['file1','file2']]
+
+    mf1 = mf.Manifest(mfpath)
+    mf1.add(files, ['md5'])
+    # Keys which are quoted, complex or not ASCII
+    for key in ['a: b', "'quoted'", 'é', 'x'*200, 'a b '*50, 'y'*125, '-dash', '#hash', ':colon.nc', '?JA',
+                '? q', ': c', '?', ':', ':'+'z'*200, '?'+'z'*200, '?\n']:
+        mf1.data[key] = {'fullpath': key, 'hashes': {'md5': 'abc'}}
+    mf1.dump()
+
+    mf2 = mf.Manifest(mfpath).load(lazy=True)
+    assert(isinstance(mf2.data, LazyData))
+    assert(os.path.exists(mfpath + index_extension))
+    assert(mf2.header == mf1.header)
+    assert(len(mf2) == len(mf1))
+    assert(mf2.contains(files[0]))
+    assert(not mf2.contains('nonexistent'))
+    assert(mf2.data.loaded() == 0)
+    assert(mf2.check_file(files[0]))
+    assert(mf2.data.loaded() == 1)
+    assert(mf2.get('x'*200, 'md5') == 'abc')
+    assert(mf2.equals(mf1) and mf1.equals(mf2))
+
+    # Sidecar index is reused while manifest is unchanged, and rebuilt after
+    mf3 = mf.Manifest(mfpath).load(lazy=True)
+    assert(sorted(mf3) == sorted(mf1))
+    mf3.delete(files[1])
+    mf3.data['new'] = {'fullpath': 'new', 'hashes': {'md5': 'abc'}}
+    assert(len(mf3) == len(mf1))
+    mf3.dump()
+    mf4 = mf.Manifest(mfpath).load(lazy=True)
+    assert(not mf4.contains(files[1]))
+    assert(mf4.get('new', 'md5') == 'abc')
+    assert(mf4.equals(mf.Manifest(mfpath).load()))
+
+    assert(yamf.main_parse_args(["check","-n",mfpath,files[0]]))
+    with pytest.raises(SystemExit):
+        yamf.main_parse_args(["check","-n",mfpath,files[1]])
+
+    # Empty manifest
+    mf.Manifest(mfpath).dump()
+    assert(len(mf.Manifest(mfpath).load(lazy=True)) == 0)
+
+def test_hash_index():
+
+    files = [os.path.join('test',f) for f in ['file1','file2','.empty']]
+
+    mf1 = mf.Manifest(None)
+    mf1.add(files[:2], ['md5','sha1'])
+    md5 = mf1.get(files[0], 'md5')
+    assert(mf1.find('md5', md5) == files[0])
+
+    # Index is maintained by add, delete and update
+    mf1.add(files[2], ['md5'])
+    assert(mf1.find('md5', mf1.get(files[2], 'md5')) == files[2])
+    mf1.delete(files[0])
+    assert(mf1.find('md5', md5) is None)
+
+    mf2 = mf.Manifest(None)
+    mf2.add(files[0], ['md5','sha256'])
+    mf1.update(mf2)
+    assert(mf1.find('md5', md5) == files[0])
+    mf1.update(mf2, newpath='elsewhere')
+    assert(mf1.find('sha256', mf2.get(files[0], 'sha256')) in [files[0], os.path.join('elsewhere','file1')])
+    mf1.delete(files[0])
+    assert(mf1.find('sha256', mf2.get(files[0], 'sha256')) == os.path.join('elsewhere','file1'))
+
+    # Stale results from altering data directly are detected, and the
+    # index rebuilt
+    emptymd5 = mf1.get(files[2], 'md5')
+    mf1.data[files[2]]['hashes']['md5'] = 'altered'
+    assert(mf1.find('md5', emptymd5) is None)
+    assert(mf1.find('md5', 'altered') == files[2])
+    assert(mf1.find('md5', None) is None)
+    assert(mf1.find('md5', ['unhashable']) is None)
+    assert(mf1.find_from_lookup('md5', 'altered') == files[2])
+
+    # Hashes added by update_matching_hashes are indexed
+    mf3 = mf.Manifest(None)
+    mf3.add(files[1], ['md5'])
+    assert(mf3.find('md5', 'anything') is None)
+    mf3.update_matching_hashes(mf1)
+    assert(mf3.find('sha1', mf1.get(files[1], 'sha1')) == files[1])
+
+    # Changes made through the manifest are found
+    mf1.add(files[1], ['sha256'])
+    mf1.delete(files[2])
+    assert(mf1.find('sha256', mf1.get(files[1], 'sha256')) == files[1])
+    assert(mf1.find('md5', 'altered') is None)
+
+    # Entries added directly, or data replaced, are found
+    mf1.data['direct'] = { 'fullpath': 'direct', 'hashes': { 'md5': 'direct' } }
+    assert(mf1.find('md5', 'direct') == 'direct')
+    mf1.data = { 'replaced': { 'fullpath': 'replaced', 'hashes': { 'md5': 'replaced' } } }
+    assert(mf1.find('md5', 'direct') is None)
+    assert(mf1.find('md5', 'replaced') == 'replaced')
+    mf4 = mf.Manifest(None)
+    mf4.data['replaced'] = { 'fullpath': 'replaced', 'hashes': { 'md5': 'other' } }
+    assert(mf1.find('md5', 'other') is None)
+    mf1.data['other'] = { 'fullpath': 'other', 'hashes': { 'md5': 'other', 'sha1': 'other' } }
+    mf4.update_matching_hashes(mf1)
+    assert(mf4.get('replaced', 'sha1') == 'other')
+
+    # An entry added directly with another removed directly is not found
+    # until data is assigned
+    del mf1.data['other']
+    mf1.data['swapped'] = { 'fullpath': 'swapped', 'hashes': { 'md5': 'swapped' } }
+    assert(mf1.find('md5', 'swapped') is None)
+    mf1.data = mf1.data
+    assert(mf1.find('md5', 'swapped') == 'swapped')
+    assert(mf1.find('md5', 'other') is None)
+
+def test_journal(tmp_path):
+
+    mfpath = str(tmp_path / 'mf1.yaml')
+    files = [os.path.join('test',f) for f in ['file1','file2','otherfile']]
+
+    mf1 = mf.Manifest(mfpath)
+    mf1.add(files[0], ['md5'])
+    mf1.dump()
+    with open(mfpath) as f:
+        original = f.read()
+
+    # Changes are appended to the journal, not the manifest
+    mf2 = mf.Manifest(mfpath, journal=True).load(lazy=True)
+    mf2.add(files[1:], ['md5'])
+    mf2.delete(files[0])
+    with open(mfpath) as f:
+        assert(f.read() == original)
+    assert(os.path.exists(mf2.journal_path()))
+
+    # and replayed when loading
+    for lazy in [False, True]:
+        mf3 = mf.Manifest(mfpath).load(lazy=lazy)
+        assert(sorted(mf3) == sorted(files[1:]))
+        assert(mf3.equals(mf2))
+
+    # Hashes added from another manifest are journalled too
+    mf4 = mf.Manifest(None)
+    mf4.add(files[1:], ['md5','sha1'])
+    mf2.update_matching_hashes(mf4)
+    mf3 = mf.Manifest(mfpath).load()
+    assert(mf3.get(files[1], 'sha1') == mf4.get(files[1], 'sha1'))
+    assert(mf3.equals(mf2))
+
+    # An incomplete final record is ignored
+    with open(mf2.journal_path(), 'a') as f:
+        f.write('["delete","test/fi')
+    assert(sorted(mf.Manifest(mfpath).load()) == sorted(files[1:]))
+
+    mf3.compact()
+    assert(not os.path.exists(mf2.journal_path()))
+    assert(sorted(mf.Manifest(mfpath).load()) == sorted(files[1:]))
+
+    yamf.main_parse_args(["add","--journal","-s","md5","-n",mfpath,files[0]])
+    assert(os.path.exists(mf2.journal_path()))
+    assert(yamf.main_parse_args(["check","-n",mfpath]))
+    assert(yamf.main_parse_args(["compact","-n",mfpath]))
+    assert(not os.path.exists(mf2.journal_path()))
+    assert(sorted(mf.Manifest(mfpath).load()) == sorted(files))
+
+def test_iter_check(tmp_path, capsys):
+
+    mfpath = str(tmp_path / 'mf1.yaml')
+    files = [os.path.join('test',f) for f in ['file1','file2','otherfile']]
+
+    mf1 = mf.Manifest(mfpath)
+    mf1.add(files, ['md5','binhash-xxh'])
+    mf1.data[files[1]]['hashes']['md5'] = 'bogus'
+
+    results = { result.path: result for result in mf1.iter_check(files) }
+    assert(sorted(results) == sorted(files))
+    for filepath, result in results.items():
+        assert(result.status == (filepath != files[1]))
+        assert(sorted(result.computed) == ['binhash-xxh','md5'])
+        assert(result.expected == mf1.data[filepath]['hashes'])
+        assert(result.bytes == os.path.getsize(filepath))
+        assert(result.elapsed >= 0)
+    assert(results[files[1]].computed['md5'] != results[files[1]].expected['md5'])
+
+    # Cascade checks are streamed in the same way
+    result = next(mf1.iter_check(files[0], hashfn='binhash-xxh', cascade='first'))
+    assert(result.status and list(result.computed) == ['binhash-xxh'])
+
+    # Files trusted by stat are not hashed
+    result, = mf1.iter_check(files[0], trust_stat=True)
+    assert(result.status and result.computed == {} and result.bytes == 0)
+
+    # Errors are raised when iter_check is called, not when iterated
+    with pytest.raises(mf.FilePathNonexistent):
+        mf1.iter_check('nonexistent')
+
+    mf1.dump()
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        yamf.main_parse_args(["check","-n",mfpath])
+    out = capsys.readouterr().out
+    for filepath in files:
+        assert('{} :: {} :: '.format(mfpath, filepath) in out)
+    assert('hashes do not match for {}: fn: md5'.format(files[1]) in out)
+
+def test_fail_fast(tmp_path):
+
+    from yamanifest.utils import SerialPool
+
+    class CountingPool(SerialPool):
+        """Serial pool which counts the tasks run"""
+        ntasks = 0
+        def imap_unordered(self, func, iterable, chunksize=1):
+            for task in iterable:
+                self.ntasks += 1
+                yield func(task)
+
+    mfpath = str(tmp_path / 'mf1.yaml')
+    files = [os.path.join('test',f) for f in ['file1','file2','otherfile','.empty']]
+
+    mf1 = mf.Manifest(mfpath, pool=CountingPool())
+    mf1.add(files, ['md5'])
+    mf1.data[files[0]]['hashes']['md5'] = 'bogus'
+
+    mf1.pool.ntasks = 0
+    hashvals = {}
+    assert(not mf1.check(hashvals=hashvals, failfast=True))
+    assert(mf1.pool.ntasks == 1)
+    assert(list(hashvals) == [files[0]])
+
+    # With condition any the first correct file decides
+    mf1.pool.ntasks = 0
+    assert(mf1.check(condition=any, failfast=True))
+    assert(mf1.pool.ntasks == 2)
+
+    mf1.pool.ntasks = 0
+    assert(not mf1.check(cascade='first', failfast=True))
+    assert(mf1.pool.ntasks == 1)
+
+    mf1.pool.ntasks = 0
+    assert(not mf1.check())
+    assert(mf1.pool.ntasks == len(files))
+
+    # Owned pools are terminated when checking stops early
+    with mf.Manifest(mfpath, backend='process') as mf2:
+        mf2.add(files, ['md5'])
+        mf2.data[files[0]]['hashes']['md5'] = 'bogus'
+        results = mf2.iter_hashes(files, ['md5'] * len(files))
+        next(results)
+        assert('process' in mf2._pools)
+        results.close()
+        assert(len(mf2._pools) == 0)
+        assert(not mf2.check(failfast=True))
+        mf2.dump()
+
+    with pytest.raises(SystemExit):
+        yamf.main_parse_args(["check","-n",mfpath,"--fail-fast"])
+    assert(yamf.main_parse_args(["check","-n",mfpath,"--fail-fast","--any"]))
+
+def test_hash_stats(tmp_path, capsys):
+
+    from yamanifest.stats import HashStats, percentile
+
+    assert(percentile([], 50) is None)
+    assert(percentile([3, 1, 2], 50) == 2)
+    assert(percentile(list(range(1, 101)), 99) == 99)
+    assert(percentile([5], 99) == 5)
+
+    files = [os.path.join('test',f) for f in ['file1','file2','otherfile']]
+
+    results = []
+    stats = HashStats()
+    mf1 = mf.Manifest(None, backend='thread', callbacks=[results.append])
+    mf1.add_callback(stats)
+    mf1.add(files, ['md5','sha1'])
+    assert(sorted(result.path for result in results) == sorted(files))
+    for result in results:
+        assert(result.bytes == os.path.getsize(result.path))
+        assert(result.elapsed >= 0 and result.cputime >= 0 and result.wait >= 0)
+        assert(result.worker is not None)
+    mf1.close()
+
+    summary = stats.summary()
+    assert(list(summary) == ['md5+sha1'])
+    assert(summary['md5+sha1']['files'] == len(files))
+    assert(summary['md5+sha1']['bytes'] == sum(os.path.getsize(f) for f in files))
+    assert(summary['md5+sha1']['p50'] <= summary['md5+sha1']['p99'])
+    assert(stats.format().startswith('md5+sha1: 3 files'))
+
+    # Values from the cache are counted separately
+    cache = str(tmp_path / 'hashes.db')
+    mf2 = mf.Manifest(None, cache=cache)
+    mf2.add(files, ['md5'])
+    stats = HashStats()
+    mf3 = mf.Manifest(None, cache=cache, callbacks=[stats])
+    mf3.add(files, ['md5','sha1'])
+    assert(stats.cached == 0 and list(stats.summary()) == ['sha1'])
+    stats = HashStats()
+    mf3.callbacks = [stats]
+    assert(mf3.check())
+    assert(stats.cached == len(files) and stats.results == [])
+
+    mfpath = str(tmp_path / 'mf1.yaml')
+    yamf.main_parse_args(["--stats","add","-n",mfpath] + files)
+    assert(yamf.main_parse_args(["--stats","check","-n",mfpath]))
+    err = capsys.readouterr().err
+    assert('binhash+md5: 3 files' in err)
+
+def test_scan_files(tmp_path):
+
+    from yamanifest.utils import scan_files
+
+    root = str(tmp_path / 'tree')
+    relpaths = [os.path.join(*parts) for parts in [('a.nc',), ('b.txt',), ('sub','c.nc'), ('sub','deeper','d.nc'),
+                                                     ('skip','e.nc'), ('sub','skip','f.nc')]]
+    for relpath in relpaths:
+        path = os.path.join(root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(relpath)
+    os.symlink(root, os.path.join(root, 'sub', 'loop'))
+
+    found = dict(scan_files(root, threads=2))
+    assert(sorted(found) == sorted(os.path.join(root, relpath) for relpath in relpaths))
+    for path, stat in found.items():
+        assert(stat.st_size == os.path.getsize(path))
+
+    found = [path for path, _ in scan_files(root, include=['*.nc'], exclude=['skip'])]
+    assert(sorted(found) == sorted(os.path.join(root, relpath) for relpath in ['a.nc', os.path.join('sub','c.nc'),
+                                                                                os.path.join('sub','deeper','d.nc')]))
+    # As with find -path, * in a path pattern also matches /
+    found = [path for path, _ in scan_files(root, include=[os.path.join('sub','*')])]
+    assert(sorted(found) == sorted(os.path.join(root, relpath) for relpath in relpaths[2:4] + relpaths[5:]))
+
+    # Stats from scanning are recorded without stat'ing files again
+    mf1 = mf.Manifest(None)
+    found = dict(scan_files(root))
+    mf1.add(list(found), ['md5'], stats=found)
+    for path in found:
+        assert(mf1.data[path]['stat'] == mf.file_stat(path))
+    assert(mf1.check(trust_stat=True))
+
+    mfpath = os.path.join(root, 'mf1.yaml')
+    yamf.main_parse_args(["add","-r","-s","md5","-n",mfpath,"--exclude","skip",root,"test/file1"])
+    mf2 = mf.Manifest(mfpath).load()
+    assert(sorted(mf2) == sorted([os.path.join(root, relpath) for relpath in relpaths[:4]] + ["test/file1"]))
+    # Files named like the manifest are added, but not its journal
+    with open(mfpath + '.nc', 'w') as f:
+        f.write('data')
+    yamf.main_parse_args(["add","-r","-s","md5","-n",mfpath,"--journal",root])
+    assert(os.path.exists(mfpath + mf.journal_extension))
+    yamf.main_parse_args(["add","-r","-s","md5","-n",mfpath,root])
+    mf3 = mf.Manifest(mfpath).load()
+    assert(len(mf3) == len(relpaths) + 2 and mf3.contains(mfpath + '.nc'))
+
+def test_probe(tmp_path):
+
+    files = [os.path.join('test',f) for f in ['file1','file2']]
+
+    # Large YAML file which is not a manifest
+    with open(str(tmp_path / 'config.yaml'), 'w') as f:
+        yaml.dump({'key{}'.format(i): list(range(10)) for i in range(10000)}, f)
+    with open(str(tmp_path / 'notmanifest.yml'), 'w') as f:
+        yaml.dump_all([{'format': 'other'}, {}], f)
+    assert(mf.probe(str(tmp_path / 'config.yaml')) is None)
+    assert(mf.probe(str(tmp_path / 'notmanifest.yml')) is None)
+    assert(mf.probe(str(tmp_path / 'nonexistent.yaml')) is None)
+
+    mf1 = mf.Manifest(str(tmp_path / 'empty.yaml'))
+    mf1.dump()
+    assert(mf.probe(mf1.path)['entries'] == 0)
+    assert(mf.Manifest.find_manifest(str(tmp_path)) is None)
+
+    mf2 = mf.Manifest(str(tmp_path / 'mf2.yaml'))
+    mf2.add(files, ['md5'])
+    mf2.dump()
+    header = mf.probe(mf2.path)
+    assert(header['format'] == 'yamanifest' and header['entries'] == 2)
+    assert(mf.Manifest.find_manifest(str(tmp_path)).equals(mf2))
+
+    mf3 = mf.Manifest(str(tmp_path / 'mf3.yamfb'))
+    mf3.add(files, ['md5'])
+    mf3.dump()
+    assert(mf.probe(mf3.path)['entries'] == 2)
+
+    # Manifests written without an entry count are loaded to find it
+    legacydir = tmp_path / 'legacy'
+    legacydir.mkdir()
+    with open(str(legacydir / 'mf4.yaml'), 'w') as f:
+        yaml.dump_all([{'format': 'yamanifest', 'version': 1.0}, mf2.data], f, default_flow_style=False)
+    assert(mf.probe(str(legacydir / 'mf4.yaml')) == {'format': 'yamanifest', 'version': 1.0})
+    assert(mf.Manifest.find_manifest(str(legacydir)).equals(mf2))
+
+    # Entries added to the journal of an empty manifest are found
+    journaldir = tmp_path / 'journal'
+    journaldir.mkdir()
+    mf5 = mf.Manifest(str(journaldir / 'mf5.yaml'))
+    mf5.dump()
+    mf5.journal = True
+    mf5.add(files[0], ['md5'])
+    assert(mf.probe(mf5.path)['entries'] == 0)
+    assert(len(mf.Manifest.find_manifest(str(journaldir))) == 1)
+
+def test_find_duplicates(tmp_path, capsys):
+
+    from yamanifest.dedup import find_duplicates
+
+    files = [os.path.join('test',f) for f in ['file1','file2','otherfile','.empty']]
+    copies = [str(tmp_path / 'copy1'), str(tmp_path / 'empty')]
+    shutil.copy(files[0], copies[0])
+    shutil.copy(files[3], copies[1])
+
+    mf1 = mf.Manifest(str(tmp_path / 'mf1.yaml'))
+    mf1.add(files[:2] + files[3:], ['md5'])
+    mf1.dump()
+    # The same files as in mf1 (file2 is a link to otherfile) are not
+    # duplicates, but copies are, even without a stored md5
+    mf2 = mf.Manifest(str(tmp_path / 'mf2.yaml'))
+    mf2.add(files[:3] + copies, ['binhash-xxh'])
+    mf2.dump()
+
+    hashed = []
+    groups = find_duplicates([mf1, mf2], callbacks=[hashed.append])
+    # Only the copy without a stored md5 is hashed
+    assert(len(hashed) == 1 and hashed[0].bytes == os.path.getsize(copies[0]))
+    assert(len(groups) == 1)
+    group = groups[0]
+    assert(group.size == os.path.getsize(files[0]))
+    assert(group.hashval == mf1.get(files[0], 'md5'))
+    assert(group.files == sorted([os.path.realpath(files[0]), copies[0]]))
+    assert(group.entries == sorted([(mf1.path, files[0]), (mf2.path, files[0]), (mf2.path, copies[0])]))
+
+    # Empty files are duplicates if requested
+    groups = find_duplicates([mf1, mf2], minsize=0)
+    assert(len(groups) == 2 and groups[0].size == 0 and len(groups[0].files) == 2)
+
+    # An entry with no recorded stat, as in manifests written before stats
+    # were recorded, is the same file as one with a stat
+    mf3 = mf.Manifest(str(tmp_path / 'mf3.yaml'))
+    mf3.add(copies[0], ['md5'])
+    del mf3.data[copies[0]]['stat']
+    mf4 = mf.Manifest(str(tmp_path / 'mf4.yaml'))
+    mf4.add(copies[0], ['md5'])
+    assert(find_duplicates([mf3, mf4]) == [])
+
+    # Files of the same size are only hashed in full if their first and last
+    # blocks are the same
+    from yamanifest.hashing import sample_hash, min_blocksize
+    block = os.urandom(min_blocksize)
+    contents = { 'first': b'a' + block[1:] + block + block, 'middle': block + b'b' + block[1:] + block,
+                 'same': block + b'c' + block[1:] + block }
+    samples = []
+    for name, data in contents.items():
+        samples.append(str(tmp_path / name))
+        with open(samples[-1], 'wb') as f:
+            f.write(data)
+    assert(sample_hash(samples[1]) == sample_hash(samples[2]) != sample_hash(samples[0]))
+    assert(sample_hash(str(tmp_path / 'nonexistent')) is None)
+    mf5 = mf.Manifest(None)
+    mf5.add(samples, ['binhash-xxh'])
+    hashed = []
+    assert(find_duplicates([mf5], callbacks=[hashed.append], threads=2) == [])
+    assert(sorted(result.bytes for result in hashed) == [len(contents['middle'])] * 2)
+
+    with pytest.raises(ValueError):
+        find_duplicates([mf1], hashfn='binhash')
+
+    capsys.readouterr()
+    assert(yamf.main_parse_args(["dupes", mf1.path, mf2.path]))
+    out = capsys.readouterr().out
+    assert('{} :: {}'.format(mf2.path, copies[0]) in out)
+    assert('1 groups of duplicate files, {} bytes reclaimable'.format(group.size) in out)
+
+def test_diff(tmp_path, capsys):
+
+    import copy
+    import json
+
+    files = [os.path.join('test',f) for f in ['file1','file2','.empty']]
+
+    mf1 = mf.Manifest(str(tmp_path / 'mf1.yaml'))
+    mf1.add(files, ['binhash-xxh','md5'])
+    assert(list(mf1.diff(mf1)) == [])
+
+    mf2 = mf.Manifest(str(tmp_path / 'mf2.yaml'))
+    mf2.data = copy.deepcopy(mf1.data)
+    # Moved
+    mf2.data['moved'] = mf2.data.pop(files[0])
+    # Removed
+    mf2.delete(files[2])
+    # Modified content, and binhash only change is not a modification
+    mf2.data[files[1]]['hashes']['md5'] = 'changed'
+    mf2.data['new'] = {'fullpath': 'new', 'hashes': {'md5': 'abc'}}
+    mf2.data['nocommon'] = {'fullpath': 'nocommon', 'hashes': {'sha1': 'abc'}}
+    mf1.data['nocommon'] = {'fullpath': 'nocommon', 'hashes': {'md5': 'abc'}}
+    mf1.data['touched'] = {'fullpath': 'touched', 'hashes': {'md5': 'abc', 'binhash': 'x'}}
+    mf2.data['touched'] = {'fullpath': 'touched', 'hashes': {'md5': 'abc', 'binhash': 'y'}}
+
+    diffs = { (d.change, d.path, d.otherpath) for d in mf1.diff(mf2) }
+    assert(diffs == { ('moved', files[0], 'moved'), ('removed', files[2], None), ('modified', files[1], files[1]),
+                      ('added', None, 'new'), ('modified', 'nocommon', 'nocommon') })
+    added, = [d for d in mf1.diff(mf2) if d.change == 'added']
+    assert(added.hashes is None and added.otherhashes == {'md5': 'abc'})
+
+    # Each entry only in the second manifest is matched once
+    mf3 = mf.Manifest(None)
+    mf4 = mf.Manifest(None)
+    for i in range(3):
+        mf3.data['a{}'.format(i)] = {'fullpath': '', 'hashes': {'md5': 'same'}}
+    for i in range(2):
+        mf4.data['b{}'.format(i)] = {'fullpath': '', 'hashes': {'md5': 'same'}}
+    changes = sorted(d.change for d in mf3.diff(mf4))
+    assert(changes == ['moved', 'moved', 'removed'])
+
+    mf1.dump()
+    mf2.dump()
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        yamf.main_parse_args(["diff", mf1.path, mf2.path])
+    lines = capsys.readouterr().out.splitlines()
+    assert(len(lines) == len(diffs))
+    assert({ (d['change'], d['path'], d['otherpath']) for d in map(json.loads, lines) } == diffs)
+    assert(yamf.main_parse_args(["diff", mf1.path, mf1.path]))
+
+def test_sharded(tmp_path):
+
+    from yamanifest.sharded import ShardedManifest, is_sharded
+
+    files = [os.path.join('test',f) for f in ['file1','file2','otherfile','.empty']]
+    copies = []
+    for subdir in ['a', 'b']:
+        os.makedirs(str(tmp_path / 'tree' / subdir))
+        for f in files[:2]:
+            copies.append(str(tmp_path / 'tree' / subdir / os.path.basename(f)))
+            shutil.copy(f, copies[-1])
+
+    for layout in ['directory', 'hash']:
+        mfpath = str(tmp_path / 'sharded-{}.yaml'.format(layout))
+        with ShardedManifest(mfpath, layout=layout, nbuckets=4) as mf1:
+            mf1.add(files + copies, ['md5'])
+            mf1.dump()
+            assert(len(mf1) == len(files) + len(copies))
+        assert(is_sharded(mfpath) and not is_sharded(str(tmp_path / 'nonexistent')))
+        assert(mf.probe(mfpath) is None)
+
+        mf2 = ShardedManifest(mfpath).load()
+        assert(mf2.layout == layout)
+        assert(len(mf2) == len(files) + len(copies) and len(mf2.shards) == 0)
+        # Shards are loaded when needed
+        assert(mf2.contains(copies[0]))
+        assert(len(mf2.shards) == 1)
+        assert(mf2.get(copies[0], 'md5') == mf2.get(files[0], 'md5'))
+        assert(not mf2.contains('nonexistent/file'))
+        assert(mf2.get('nonexistent/file', 'md5') is None)
+        assert(sorted(mf2) == sorted(files + copies))
+
+        # Each shard is an ordinary manifest which can be checked by itself
+        for key in mf2.index:
+            assert(mf.Manifest(mf2.shard_path(key)).load().check())
+
+        assert(mf2.check())
+        assert(mf2.check(threads=2))
+        assert(mf2.check_file(copies[:2]))
+        with pytest.raises(mf.FilePathNonexistent):
+            mf2.check_file('nonexistent/file')
+
+        # Only changed shards are written
+        mtimes = { key: os.stat(mf2.shard_path(key)).st_mtime_ns for key in mf2.index }
+        changed = mf2.shard_key(copies[0])
+        mf2.shards[changed].data[copies[0]]['hashes']['md5'] = 'bogus'
+        mf2.dirty.add(changed)
+        mf2.delete(copies[1])
+        changed = set([changed, mf2.shard_key(copies[1])])
+        mf2.dump()
+        for key in mf2.index:
+            if key not in changed:
+                assert(os.stat(mf2.shard_path(key)).st_mtime_ns == mtimes[key])
+        mf2.close()
+
+        mf3 = ShardedManifest(mfpath).load()
+        assert(not mf3.contains(copies[1]))
+        hashvals = {}
+        assert(not mf3.check(hashvals=hashvals, threads=2))
+        assert(list(hashvals) == [copies[0]])
+        assert(not mf3.check(failfast=True))
+        assert(not mf3.check(failfast=True, threads=2))
+        # Results from several threads are streamed, and closing stops them
+        results = mf3.iter_check(None, threads=2)
+        assert(next(results).path in mf3)
+        results.close()
+        mf3.close()
+
+    # Shards share one pool, and a hash cache, between threads
+    from yamanifest.cache import HashCache
+    cache = HashCache(str(tmp_path / 'cache.db'))
+    mfpath = str(tmp_path / 'pooled.yaml')
+    with ShardedManifest(mfpath, backend='thread', numproc=2, cache=cache) as mf5:
+        mf5.add(copies + files[:1], ['md5'])
+        pools = [ shard.pool for shard in mf5.shards.values() ]
+        assert(len(pools) == 3 and pools[0] is not None and all(pool is pools[0] for pool in pools))
+        mf5.dump()
+    with ShardedManifest(mfpath, backend='process', numproc=2, cache=cache).load() as mf5:
+        assert(mf5.check(threads=2))
+        pools = [ shard.pool for shard in mf5.shards.values() ]
+        assert(pools[0] is not None and all(pool is pools[0] for pool in pools))
+    assert(yamf.main_parse_args(["check","-n",mfpath,"--threads","2","--cache",str(tmp_path / 'cache.db')]))
+    # Small operations with the auto backend do not start a pool
+    for backend in ['serial', 'auto']:
+        with ShardedManifest(mfpath, backend=backend).load() as mf5:
+            assert(mf5.check(threads=2))
+            mf5.add(files[1:2], ['md5'])
+            assert(all(shard.pool is None for shard in mf5.shards.values()))
+
+    # Deleting all entries of a shard removes it
+    mfpath = str(tmp_path / 'sharded-hash.yaml')
+    mf4 = ShardedManifest(mfpath).load()
+    for filepath in list(mf4):
+        mf4.delete(filepath)
+    mf4.dump()
+    assert(mf4.index == {} and os.listdir(mfpath + '.shards') == [])
+
+    with pytest.raises(ValueError):
+        ShardedManifest(mfpath, layout='bogus')
+
+    mfpath = str(tmp_path / 'yamf.yaml')
+    yamf.main_parse_args(["add","-n",mfpath,"--shard-by","directory","-s","md5"] + copies)
+    assert(is_sharded(mfpath))
+    yamf.main_parse_args(["add","-n",mfpath,"--journal","-s","md5"] + files)
+    assert(len(ShardedManifest(mfpath).load()) == len(files) + len(copies))
+    assert(yamf.main_parse_args(["check","-n",mfpath,"--threads","2"]))
+    assert(yamf.main_parse_args(["check","-n",mfpath,copies[0]]))
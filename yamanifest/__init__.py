@@ -1,3 +1,5 @@
 from .manifest import HashExists, FilePathNonexistent, HashNonexistent, Manifest
 
-from .hashing import hash, supported_hashes
+from .hashing import hash, hash_many, supported_hashes
+from .cache import HashCache
+from .sharded import ShardedManifest
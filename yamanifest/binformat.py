@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ACCESS-NRI
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compact binary manifest format. All integers are little endian.
+
+    magic           8 bytes, MAGIC
+    header          uint32 length, JSON encoded header
+    string table    uint32 count, then uint32 length and UTF-8 bytes for each string
+    records         uint32 count, then for each entry:
+        path            uint32 directory, uint32 basename (string table indices)
+        flags           uint8, bit 0: fullpath, bit 1: stat, bit 2: extra,
+                        bit 3: fullpath prefix
+        fullpath        uint32 directory, uint32 basename, if flagged, or
+                        uint32 prefix, if flagged as a prefix of the path
+        hashes          uint8 count, then for each hash:
+                            uint32 hash function (string table index)
+                            uint8 kind, then
+                                HEX:    uint8 length, raw digest bytes
+                                STRING: uint32 string table index
+                                JSON:   uint32 string table index of JSON value
+        stat            int64 size, int64 mtime_ns, uint64 inode, uint64 device, if flagged
+        extra           uint32 string table index of JSON dict of other keys, if flagged
+
+Paths are split into directory and basename so directories are stored once.
+A directory index of NONE means the path has no directory. A fullpath which
+ends with the path, as it usually does, is stored as the string before it,
+so a common prefix is only stored once. Version 1 files, which have no
+prefixes, can still be read.
+"""
+
+from __future__ import print_function, absolute_import
+
+import json
+import struct
+
+MAGIC = b'YAMFBIN\x02'
+
+# Magic numbers of all versions which can be read
+_magics = (b'YAMFBIN\x01', MAGIC)
+
+# File extension used to select the binary format
+extension = '.yamfb'
+
+NONE = 0xFFFFFFFF
+
+FULLPATH, STAT, EXTRA, PREFIX = 1, 2, 4, 8
+HEX, STRING, JSON = 0, 1, 2
+
+_uint8 = struct.Struct('<B')
+_uint32 = struct.Struct('<I')
+_path = struct.Struct('<II')
+_hash = struct.Struct('<IB')
+_stat = struct.Struct('<qqQQ')
+
+_statkeys = ('size', 'mtime_ns', 'inode', 'device')
+
+def is_binary(path):
+    """
+    Return True if path is a binary format manifest
+    """
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(MAGIC)) in _magics
+    except (IOError, OSError):
+        return False
+
+class _StringTable(object):
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, string):
+        idx = self.index.get(string)
+        if idx is None:
+            idx = self.index[string] = len(self.strings)
+            self.strings.append(string)
+        return idx
+
+    def add_path(self, path):
+        dirname, sep, basename = path.rpartition('/')
+        if sep == '':
+            return NONE, self.add(basename)
+        return self.add(dirname), self.add(basename)
+
+def _is_hex(value):
+    try:
+        return bytes.fromhex(value).hex() == value and len(value) < 512
+    except (TypeError, ValueError):
+        return False
+
+def dumps(header, data):
+    """
+    Return binary encoding of manifest header and data
+    """
+    strings = _StringTable()
+    records = []
+    for filepath, entry in data.items():
+        flags = 0
+        record = [_path.pack(*strings.add_path(filepath))]
+        extra = { key: val for key, val in entry.items() if key not in ('fullpath', 'hashes', 'stat') }
+        if 'fullpath' in entry:
+            if isinstance(entry['fullpath'], str) and entry['fullpath'].endswith(filepath):
+                flags |= PREFIX
+                prefix = entry['fullpath'][:len(entry['fullpath'])-len(filepath)]
+                record.append(_uint32.pack(strings.add(prefix)))
+            elif isinstance(entry['fullpath'], str):
+                flags |= FULLPATH
+                record.append(_path.pack(*strings.add_path(entry['fullpath'])))
+            else:
+                extra['fullpath'] = entry['fullpath']
+        hashes = entry.get('hashes', {})
+        record.append(_uint8.pack(len(hashes)))
+        for hashfn, hashval in hashes.items():
+            if _is_hex(hashval):
+                digest = bytes.fromhex(hashval)
+                record.append(_hash.pack(strings.add(hashfn), HEX) + _uint8.pack(len(digest)) + digest)
+            elif isinstance(hashval, str):
+                record.append(_hash.pack(strings.add(hashfn), STRING) + _uint32.pack(strings.add(hashval)))
+            else:
+                record.append(_hash.pack(strings.add(hashfn), JSON) + _uint32.pack(strings.add(json.dumps(hashval))))
+        stat = entry.get('stat')
+        if stat is not None:
+            try:
+                if sorted(stat) != sorted(_statkeys):
+                    raise TypeError
+                record.append(_stat.pack(*[stat[key] for key in _statkeys]))
+                flags |= STAT
+            except (TypeError, struct.error):
+                extra['stat'] = stat
+        if 'hashes' not in entry:
+            extra['hashes'] = None
+        if len(extra) > 0:
+            flags |= EXTRA
+            record.append(_uint32.pack(strings.add(json.dumps(extra))))
+        record.insert(1, _uint8.pack(flags))
+        records.append(b''.join(record))
+
+    headerbytes = json.dumps(header).encode('utf-8')
+    chunks = [MAGIC, _uint32.pack(len(headerbytes)), headerbytes, _uint32.pack(len(strings.strings))]
+    for string in strings.strings:
+        encoded = string.encode('utf-8', 'surrogateescape')
+        chunks.append(_uint32.pack(len(encoded)))
+        chunks.append(encoded)
+    chunks.append(_uint32.pack(len(records)))
+    chunks.extend(records)
+    return b''.join(chunks)
+
+def loads(buf):
+    """
+    Return (header, data) decoded from binary manifest
+    """
+    if bytes(buf[:len(MAGIC)]) not in _magics:
+        raise ValueError('Not yamanifest binary format')
+    pos = len(MAGIC)
+    (length,) = _uint32.unpack_from(buf, pos)
+    pos += 4
+    header = json.loads(buf[pos:pos+length].decode('utf-8'))
+    pos += length
+
+    (count,) = _uint32.unpack_from(buf, pos)
+    pos += 4
+    strings = []
+    for _ in range(count):
+        (length,) = _uint32.unpack_from(buf, pos)
+        pos += 4
+        strings.append(buf[pos:pos+length].decode('utf-8', 'surrogateescape'))
+        pos += length
+
+    def path(dirname, basename):
+        if dirname == NONE:
+            return strings[basename]
+        return strings[dirname] + '/' + strings[basename]
+
+    (count,) = _uint32.unpack_from(buf, pos)
+    pos += 4
+    data = {}
+    for _ in range(count):
+        filepath = path(*_path.unpack_from(buf, pos))
+        flags = buf[pos+8]
+        pos += 9
+        entry = {}
+        if flags & FULLPATH:
+            entry['fullpath'] = path(*_path.unpack_from(buf, pos))
+            pos += 8
+        elif flags & PREFIX:
+            (idx,) = _uint32.unpack_from(buf, pos)
+            entry['fullpath'] = strings[idx] + filepath
+            pos += 4
+        nhashes = buf[pos]
+        pos += 1
+        hashes = {}
+        for _ in range(nhashes):
+            hashfn, kind = _hash.unpack_from(buf, pos)
+            pos += 5
+            if kind == HEX:
+                length = buf[pos]
+                hashes[strings[hashfn]] = buf[pos+1:pos+1+length].hex()
+                pos += 1 + length
+            else:
+                (idx,) = _uint32.unpack_from(buf, pos)
+                pos += 4
+                if kind == STRING:
+                    hashes[strings[hashfn]] = strings[idx]
+                else:
+                    hashes[strings[hashfn]] = json.loads(strings[idx])
+        entry['hashes'] = hashes
+        if flags & STAT:
+            entry['stat'] = dict(zip(_statkeys, _stat.unpack_from(buf, pos)))
+            pos += _stat.size
+        if flags & EXTRA:
+            (idx,) = _uint32.unpack_from(buf, pos)
+            pos += 4
+            entry.update(json.loads(strings[idx]))
+            if entry['hashes'] is None:
+                del entry['hashes']
+        data[filepath] = entry
+    return header, data
+
+def dump(header, data, path):
+    """
+    Write manifest header and data to path in binary format
+    """
+    with open(path, 'wb') as file:
+        file.write(dumps(header, data))
+
+def load(path):
+    """
+    Return (header, data) read from binary format manifest at path
+    """
+    with open(path, 'rb') as file:
+        return loads(file.read())
+
+def load_header(path):
+    """
+    Return header read from binary format manifest at path, without
+    reading the entries
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) not in _magics:
+            raise ValueError('Not yamanifest binary format')
+        (length,) = _uint32.unpack(file.read(4))
+        return json.loads(file.read(length).decode('utf-8'))
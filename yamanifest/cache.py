@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ACCESS-NRI
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import sqlite3
+import threading
+
+from .hashing import binhashes
+
+def default_cache_path():
+    """
+    Return default location of the hash cache database
+    """
+    cachedir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cachedir, 'yamanifest', 'hashes.db')
+
+class HashCache(object):
+    """A persistent cache of hash values, stored in a SQLite database
+
+    Hash values are keyed on the device, inode, size and modification time of
+    the file, and the hashing function, so can be shared between manifests and
+    between runs. When there are more than maxentries values the least recently
+    used are evicted. A cache can be used from more than one thread, e.g. by
+    manifests hashing in different threads.
+
+    Attributes:
+        path: path to the SQLite database file
+        maxentries: maximum number of hash values stored
+    """
+
+    def __init__(self, path=None, maxentries=1000000):
+        if path is None:
+            path = default_cache_path()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.maxentries = maxentries
+        # The connection is shared by threads, which take turns to use it
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                              'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+                              'name TEXT, hashfn TEXT, hashval TEXT, used INTEGER, '
+                              'PRIMARY KEY (device, inode, size, mtime_ns, name, hashfn))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def _tick(self):
+        # Monotonically increasing counter used to order values by last use.
+        # Stored in the database so it is consistent between processes
+        return self.conn.execute('SELECT COALESCE(MAX(used), 0) + 1 FROM hashes').fetchone()[0]
+
+    def _key(self, stat, path, hashfn):
+        # binhashes include the file name, so hard links to the same inode
+        # with different names have different values
+        name = os.path.basename(path) if hashfn in binhashes else ''
+        return (stat['device'], stat['inode'], stat['size'], stat['mtime_ns'], name, hashfn)
+
+    def get_many(self, items):
+        """
+        Return list of cached hash values for a list of (stat, path, hashfn)
+        items, with None where there is no cached value
+        """
+        hashvals = []
+        used = []
+        with self.lock:
+            now = self._tick()
+            for stat, path, hashfn in items:
+                hashval = None
+                if stat is not None:
+                    key = self._key(stat, path, hashfn)
+                    row = self.conn.execute('SELECT hashval FROM hashes WHERE device=? AND inode=? AND size=? '
+                                            'AND mtime_ns=? AND name=? AND hashfn=?', key).fetchone()
+                    if row is not None:
+                        hashval = row[0]
+                        used.append((now,) + key)
+                hashvals.append(hashval)
+            if len(used) > 0:
+                with self.conn:
+                    self.conn.executemany('UPDATE hashes SET used=? WHERE device=? AND inode=? AND size=? '
+                                          'AND mtime_ns=? AND name=? AND hashfn=?', used)
+        return hashvals
+
+    def get(self, stat, path, hashfn):
+        """
+        Return cached hash value for file with stat and path, or None
+        """
+        return self.get_many([(stat, path, hashfn)])[0]
+
+    def put_many(self, items):
+        """
+        Save a list of (stat, path, hashfn, hashval) items to the cache, and
+        evict least recently used values if it is over size
+        """
+        with self.lock:
+            now = self._tick()
+            rows = [ self._key(stat, path, hashfn) + (hashval, now)
+                     for stat, path, hashfn, hashval in items if stat is not None ]
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                excess = len(self) - self.maxentries
+                if excess > 0:
+                    self.conn.execute('DELETE FROM hashes WHERE rowid IN '
+                                      '(SELECT rowid FROM hashes ORDER BY used LIMIT ?)', (excess,))
+
+    def put(self, stat, path, hashfn, hashval):
+        """
+        Save hash value for file with stat and path to the cache
+        """
+        self.put_many([(stat, path, hashfn, hashval)])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ACCESS-NRI
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+from .hashing import binhashes, sample_hash
+from .manifest import Manifest, file_stat
+
+# Files with the same contents: size in bytes, hash value of the contents,
+# the full paths of the files, and the (manifest path, filepath) of each
+# entry for them in the manifests
+DuplicateGroup = namedtuple('DuplicateGroup', ['size', 'hashval', 'files', 'entries'])
+
+def find_duplicates(manifests, hashfn='md5', minsize=1, threads=None, **kwargs):
+    """
+    Return a list of DuplicateGroups of files in manifests with the same
+    contents. Files are grouped by size, using the size recorded in the
+    manifest if present. Only files with the same size are compared, by
+    their value of hashfn, which must hash the full contents of a file.
+    Values stored in the manifests are used. Files with no stored value
+    which have the same size as another file are compared by a sample of
+    their first and last blocks (see sample_hash), read by a pool of
+    threads, and only those with the same sample as another file are
+    hashed in full, using a Manifest created with kwargs (e.g. backend or
+    cache). Stored values are trusted, so manifests should be checked
+    first. Files smaller than minsize bytes are ignored
+    """
+    if hashfn in binhashes:
+        raise ValueError('{} does not hash the full contents of files'.format(hashfn))
+
+    # Group entries by size, merging entries which are the same file
+    bysize = defaultdict(dict)
+    for manifest in manifests:
+        for filepath in manifest:
+            entry = manifest.data[filepath]
+            stat = entry.get('stat')
+            if stat is None:
+                stat = file_stat(entry['fullpath'])
+                if stat is None:
+                    continue
+            if stat['size'] < minsize:
+                continue
+            # Identify files by device and inode, from the recorded stat or
+            # the file, so the same file in more than one manifest, or hard
+            # links to it, are not duplicates
+            identity = (stat['device'], stat['inode'])
+            files = bysize[stat['size']].setdefault(identity, [entry['fullpath'], None, []])
+            files[2].append((manifest.path, filepath))
+            if files[1] is None:
+                files[1] = entry['hashes'].get(hashfn)
+
+    # Sample files of the same size as a file without a stored value
+    tosample = []
+    for size, files in bysize.items():
+        if len(files) > 1 and any(hashval is None for (_, hashval, _) in files.values()):
+            tosample.extend((size, identity) for identity in files)
+    samples = []
+    if len(tosample) > 0:
+        if threads is None:
+            threads = min(32, (os.cpu_count() or 1) + 4)
+        pool = ThreadPool(threads)
+        try:
+            samples = pool.map(sample_hash, [bysize[size][identity][0] for (size, identity) in tosample])
+        finally:
+            pool.close()
+            pool.join()
+    bysample = defaultdict(list)
+    for (size, identity), sample in zip(tosample, samples):
+        if sample is not None:
+            bysample[(size, sample)].append(identity)
+
+    # Hash only files without a stored value which may be duplicates
+    hasher = Manifest(None, hashes=[hashfn], **kwargs)
+    try:
+        tohash = []
+        for (size, _), identities in bysample.items():
+            if len(identities) < 2:
+                continue
+            for identity in identities:
+                fullpath, hashval, _ = bysize[size][identity]
+                if hashval is None:
+                    key = '{}:{}'.format(size, len(tohash))
+                    hasher.data[key] = { 'fullpath': fullpath, 'hashes': {} }
+                    tohash.append((size, identity, key))
+        if len(tohash) > 0:
+            hashvals = hasher.calc_hashes([key for (_, _, key) in tohash], [hashfn] * len(tohash))
+            for size, identity, key in tohash:
+                bysize[size][identity][1] = hashvals[key][hashfn]
+    finally:
+        hasher.close()
+
+    groups = []
+    for size, files in sorted(bysize.items()):
+        if len(files) < 2:
+            continue
+        byhash = defaultdict(list)
+        for fullpath, hashval, entries in files.values():
+            if hashval is not None:
+                byhash[hashval].append((fullpath, entries))
+        for hashval, duplicates in sorted(byhash.items()):
+            if len(duplicates) > 1:
+                groups.append(DuplicateGroup(size, hashval, sorted(fullpath for (fullpath, _) in duplicates),
+                                             sorted((entry for (_, entries) in duplicates for entry in entries), key=str)))
+    return groups
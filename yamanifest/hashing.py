@@ -23,66 +23,283 @@ from __future__ import absolute_import, print_function
 import hashlib
 import xxhash # Fast hashing library
 import io
+import mmap
 import os
 import sys
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 length=io.DEFAULT_BUFFER_SIZE
 one_hundred_megabytes = 104857600
 
+# Minimum size of blocks read from files for hashing
+min_blocksize = 1048576
+
+# Methods of reading files for hashing. Files which cannot be memory
+# mapped are always read
+read_methods = ['mmap', 'read']
+
 # List of supported hashes and the ordering used to determine relative expense of
 # calculation
 supported_hashes = [
-    'binhash-xxh','binhash', 'binhash-nomtime', 'md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'
+    'binhash-xxh','binhash', 'binhash-nomtime', 'xxh3-tree', 'md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'
 ]
 
-def _binhash(path, size, include_mtime, use_xxh=False):
+# Hashes which only read the first part of a file, and also include the file
+# name and size (and optionally modification time). Useful for change detection,
+# but not for comparing file contents
+binhashes = ['binhash-xxh', 'binhash', 'binhash-nomtime']
+
+# Hashes which split a file into blocks that are hashed in parallel. The
+# block size is part of the hash value, so it can be reproduced
+treehashes = ['xxh3-tree']
+
+# Default size of blocks for tree hashes
+tree_blocksize = 67108864
+
+def sort_by_cost(hashfns):
+    """
+    Return hash functions sorted from cheapest to most expensive, as defined
+    by the order of supported_hashes. Unsupported hashes are last
+    """
+    def cost(hashfn):
+        if hashfn in supported_hashes:
+            return supported_hashes.index(hashfn)
+        return len(supported_hashes)
+    return sorted(hashfns, key=cost)
 
-    m = xxhash.xxh3_64() if use_xxh else hashlib.new('md5')
+def _binhash_extent(filesize, size):
+    """
+    Return the number of bytes of a file included in a binhash. The original
+    implementation read in chunks of length bytes and discarded the chunk which
+    reached size, so this is retained for existing binhash values to be valid
+    """
+    if filesize < size:
+        return filesize
+    return ((size - 1) // length) * length
 
-    with io.open(path, mode="rb") as fd:
+def _new_hasher(path, hashfn, size):
+    """
+    Return a new hash object for hashfn, and the number of bytes of path
+    it should consume (None for the whole file)
+    """
+    if hashfn in binhashes:
+        m = xxhash.xxh3_64() if hashfn == 'binhash-xxh' else hashlib.new('md5')
         # Size limited hashing, so prepend the filename, size and optionally modification time 
-        hashstring = os.path.basename(path) + str(os.path.getsize(path))
-        if include_mtime:
+        filesize = os.path.getsize(path)
+        hashstring = os.path.basename(path) + str(filesize)
+        if hashfn != 'binhash-nomtime':
             hashstring +=str(os.path.getmtime(path))
         m.update(hashstring.encode())
-        tot = 0
-        for chunk in iter(lambda: fd.read(length), b''):
-            tot += len(chunk)
-            if tot >= size:
-                rem = (size-tot)
-                if rem <= 0:
-                    break
-                chunk = chunk[:rem]
-            m.update(chunk)
-    return m.hexdigest()
+        return m, _binhash_extent(filesize, size)
+    else:
+        return hashlib.new(hashfn), None
+
+def auto_blocksize(st_blksize):
+    """
+    Return block size for reading a file with preferred I/O size st_blksize
+    (as reported by stat): the smallest multiple of it which is at least
+    min_blocksize. On parallel filesystems st_blksize is typically the
+    stripe size
+    """
+    if not st_blksize or st_blksize <= 0:
+        return min_blocksize
+    return st_blksize * max(1, -(-min_blocksize // st_blksize))
 
-def _hashlib(path, hashfn):
-    # from https://stackoverflow.com/a/40961519
-    m = hashlib.new(hashfn)
-    with io.open(path, mode="rb") as fd:
-        for chunk in iter(lambda: fd.read(length), b''):
+def _consume(hashers, chunk, pos):
+    """
+    Pass a chunk of data starting at byte pos to all the hashers, truncating
+    it for size limited hashes. Return the position of the end of the chunk
+    """
+    end = pos + len(chunk)
+    for (_, m, limit) in hashers:
+        if limit is None or end <= limit:
             m.update(chunk)
-    return m.hexdigest()
+        elif pos < limit:
+            m.update(chunk[:limit-pos])
+    return end
 
-def hash(path, hashfn, size=one_hundred_megabytes):
-    """ A simple wrapper that inspects the hashing function and intercepts
-    calls to nchash and binhash so they are processed in a special way.
+def _hash_read(fd, hashers, maxlimit, blocksize):
+    """
+    Hash data from a file, reading blocks into a single reused buffer
+    """
+    buf = bytearray(blocksize)
+    with memoryview(buf) as view:
+        pos = 0
+        while maxlimit is None or pos < maxlimit:
+            nbytes = fd.readinto(view)
+            if not nbytes:
+                break
+            with view[:nbytes] as chunk:
+                pos = _consume(hashers, chunk, pos)
 
-    TODO: make plugins that allow this transparently
+def _hash_mmap(fd, hashers, maxlimit, blocksize):
+    """
+    Hash data from a file by memory mapping it and passing slices of the
+    mapping directly to the hash functions, avoiding copying the data. Return
+    False if the file cannot be memory mapped, e.g. empty or special files
+    """
+    try:
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, OverflowError):
+        return False
+    try:
+        with memoryview(mm) as view:
+            end = len(view) if maxlimit is None else min(len(view), maxlimit)
+            pos = 0
+            while pos < end:
+                with view[pos:pos+blocksize] as chunk:
+                    pos = _consume(hashers, chunk, pos)
+    finally:
+        mm.close()
+    return True
+
+def _pread_into(fd, view, offset):
+    """
+    Read into a buffer from a position in a file without changing the file offset
     """
-    if hashfn not in supported_hashes:
-        sys.stderr.write('\nUnsupported hash function {}, skipping {}\n'.format(hashfn, path))
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [view], offset)
+    data = os.pread(fd, len(view), offset)
+    view[:len(data)] = data
+    return len(data)
+
+def _tree_block(path, blocksize, readsize, offset):
+    """
+    Return digest of the block of blocksize bytes of path starting at offset
+    """
+    m = xxhash.xxh3_128()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        buf = bytearray(min(readsize, blocksize))
+        with memoryview(buf) as view:
+            pos = offset
+            end = offset + blocksize
+            while pos < end:
+                nbytes = _pread_into(fd, view[:min(len(buf), end-pos)], pos)
+                if not nbytes:
+                    break
+                with view[:nbytes] as chunk:
+                    m.update(chunk)
+                pos += nbytes
+    finally:
+        os.close(fd)
+    return m.digest()
+
+def parse_tree_hash(hashval):
+    """
+    Return (blocksize, digest) from a tree hash value, or None if it is not valid
+    """
+    try:
+        blocksize, digest = hashval.split(':')
+        return int(blocksize), digest
+    except (AttributeError, ValueError):
+        return None
+
+def tree_hash(path, blocksize=None, threads=None, readsize=None):
+    """ Calculate an xxh3-tree hash of path. The file is split into blocks of
+    blocksize bytes, which are hashed in parallel by a number of threads
+    (default is the number of CPUs) using positional reads. The root digest
+    is the hash of the block digests.
+
+    Returns hash value of the form <blocksize>:<root digest>
+    """
+    if blocksize is None:
+        blocksize = tree_blocksize
+    filesize = os.path.getsize(path)
+    if readsize is None:
+        readsize = auto_blocksize(getattr(os.stat(path), 'st_blksize', None))
+    offsets = list(range(0, filesize, blocksize))
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = min(threads, len(offsets))
+    hashblock = partial(_tree_block, path, blocksize, readsize)
+    if threads > 1:
+        with ThreadPool(threads) as pool:
+            digests = pool.map(hashblock, offsets)
+    else:
+        digests = [ hashblock(offset) for offset in offsets ]
+    m = xxhash.xxh3_128()
+    m.update(str(filesize).encode())
+    for digest in digests:
+        m.update(digest)
+    return '{}:{}'.format(blocksize, m.hexdigest())
+
+def hash_many(path, hashfns, size=one_hundred_megabytes, method='read', blocksize=None,
+              treeblocksize=None, treethreads=None):
+    """ Calculate a number of hashes for path, reading the file only once.
+    Each chunk read is passed to all the hash functions. Size limited hashes
+    (binhash) stop consuming data at their limit, and reading stops when
+    no hash requires any more data.
+
+    By default files are read in blocks into a reused buffer (method='read').
+    With method='mmap' files are memory mapped instead, falling back to
+    buffered reads for files which cannot be mapped. A file must not be
+    truncated while it is memory mapped, as accessing the mapping then kills
+    the process (SIGBUS), so only use method='mmap' for files which will
+    not be modified while they are being hashed.
+
+    Data is read in blocks of blocksize bytes. If not specified it is
+    determined from the preferred I/O size of the file (see auto_blocksize).
+
+    Tree hashes are calculated separately, with treeblocksize and treethreads
+    passed to tree_hash.
+
+    Returns a dict of hash values keyed by hash function. Values are None if
+    path cannot be hashed
+    """
+    if method not in read_methods:
+        raise ValueError('Unknown read method {}, must be one of {}'.format(method, read_methods))
+    for hashfn in hashfns:
+        if hashfn not in supported_hashes:
+            sys.stderr.write('\nUnsupported hash function {}, skipping {}\n'.format(hashfn, path))
     try:
-        if hashfn == 'binhash-xxh':
-            return _binhash(path, one_hundred_megabytes, True, use_xxh=True)
-        elif hashfn == 'binhash':
-            return _binhash(path, one_hundred_megabytes, True)
-        elif hashfn == 'binhash-nomtime':
-            return _binhash(path, one_hundred_megabytes, False)
+        hashvals = { hashfn: tree_hash(path, treeblocksize, treethreads, blocksize)
+                     for hashfn in hashfns if hashfn in treehashes }
+        hashers = [ (hashfn,) + _new_hasher(path, hashfn, size) for hashfn in hashfns
+                    if hashfn not in treehashes ]
+        limits = [ limit for (_, _, limit) in hashers ]
+        if len(hashers) == 0:
+            return hashvals
+        if None in limits:
+            maxlimit = None
         else:
-            return _hashlib(path, hashfn)
+            maxlimit = max(limits, default=0)
+        with io.open(path, mode="rb", buffering=0) as fd:
+            if blocksize is None:
+                blocksize = auto_blocksize(getattr(os.fstat(fd.fileno()), 'st_blksize', None))
+            if method != 'mmap' or not _hash_mmap(fd, hashers, maxlimit, blocksize):
+                _hash_read(fd, hashers, maxlimit, blocksize)
+        hashvals.update({ hashfn: m.hexdigest() for (hashfn, m, _) in hashers })
+        return hashvals
     except IOError as e:
         sys.stderr.write('{}\nCannot hash, skipping {}\n'.format(str(e),path))
-        return None
-        
+        return dict.fromkeys(hashfns)
+
+def hash(path, hashfn, size=one_hundred_megabytes):
+    """ A simple wrapper that calculates a single hash for path. Calls to
+    binhash are processed in a special way.
+
+    TODO: make plugins that allow this transparently
+    """
+    return hash_many(path, [hashfn], size)[hashfn]
 
+def sample_hash(path, blocksize=min_blocksize):
+    """ Calculate an xxh3 hash of the size of path and its first and last
+    blocksize bytes. Unlike binhash it does not include the file name, so
+    can be used to compare the contents of files cheaply: files with
+    different values differ, but files with the same value may not be the
+    same. Returns None if path cannot be read
+    """
+    try:
+        with io.open(path, mode="rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            m = xxhash.xxh3_64()
+            m.update(str(size).encode())
+            m.update(fd.read(blocksize))
+            if size > blocksize:
+                fd.seek(max(blocksize, size - blocksize))
+                m.update(fd.read(blocksize))
+        return m.hexdigest()
+    except (IOError, OSError):
+        return None
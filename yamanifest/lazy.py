@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ACCESS-NRI
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import json
+import os
+
+from collections.abc import MutableMapping
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Extension of the sidecar file used to save the index of a manifest
+index_extension = '.idx'
+
+def _is_indicator(line, indicator):
+    # A complex key starts with '? ' and its value with ': '. Plain keys
+    # may also start with '?' or ':', e.g. ':file.nc'
+    return line[:1] == indicator and line[1:2] in (b' ', b'\n', b'\r', b'')
+
+def _is_entry_start(line):
+    # Entries in the data document start in the first column. Indented lines
+    # are the contents of an entry, and lines starting with ': ' are the value
+    # of a complex ('? ') key
+    return (line[:1] not in (b' ', b'#', b'\n', b'\r', b'') and not _is_indicator(line, b':')
+            and not line.startswith(b'...'))
+
+def _parse_key(lines):
+    """
+    Return the key of a manifest entry, given its first lines
+    """
+    if _is_indicator(lines[0], b'?'):
+        text = b''.join(lines) + b':'
+    else:
+        text = lines[0]
+    (key,) = yaml.load(text.decode('utf-8'), Loader=SafeLoader).keys()
+    return key
+
+def build_index(path):
+    """
+    Scan a YAML manifest and return the header, and a list of the key, byte
+    offset and length of each entry in the data document. Only the header and
+    the keys are parsed
+    """
+    headerlines = []
+    entries = []
+    with open(path, 'rb') as file:
+        pos = 0
+        for line in file:
+            pos += len(line)
+            if line.startswith(b'---'):
+                if pos == len(line):
+                    # Explicit start of the header document
+                    continue
+                if line.strip() != b'---':
+                    # Data document is not in block style, e.g. --- {}
+                    if yaml.load(line[3:].decode('utf-8'), Loader=SafeLoader):
+                        raise ValueError('Cannot index manifest data in flow style')
+                    return yaml.load(b''.join(headerlines).decode('utf-8'), Loader=SafeLoader), entries
+                break
+            headerlines.append(line)
+        header = yaml.load(b''.join(headerlines).decode('utf-8'), Loader=SafeLoader)
+
+        start = None
+        keylines = []
+        keydone = True
+        for line in file:
+            if line.startswith(b'---') or line.startswith(b'...'):
+                break
+            if _is_entry_start(line):
+                if start is not None:
+                    entries.append([_parse_key(keylines), start, pos - start])
+                start = pos
+                keylines = [line]
+                keydone = not _is_indicator(line, b'?')
+            elif not keydone:
+                if _is_indicator(line, b':'):
+                    keydone = True
+                else:
+                    keylines.append(line)
+            pos += len(line)
+        if start is not None:
+            entries.append([_parse_key(keylines), start, pos - start])
+    return header, entries
+
+def load_index(path):
+    """
+    Return header and entry index for a YAML manifest. The index is saved
+    to a sidecar file, and reused while the manifest is unchanged
+    """
+    st = os.stat(path)
+    indexpath = path + index_extension
+    try:
+        with open(indexpath, 'r') as file:
+            index = json.load(file)
+        if index['size'] == st.st_size and index['mtime_ns'] == st.st_mtime_ns:
+            return index['header'], index['entries']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    header, entries = build_index(path)
+    try:
+        with open(indexpath, 'w') as file:
+            json.dump({ 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                        'header': header, 'entries': entries }, file)
+    except (IOError, OSError, TypeError, ValueError):
+        # Index is an optimisation, so not being able to save it is not an error
+        pass
+    return header, entries
+
+class LazyData(MutableMapping):
+    """Manifest data which is parsed from a YAML manifest on demand
+
+    Entries are located using an index of their byte offsets, and each
+    is parsed the first time it is accessed. New and altered entries are
+    held in memory.
+    """
+
+    def __init__(self, path, entries):
+        self.path = path
+        self.offsets = { key: (offset, length) for (key, offset, length) in entries }
+        self.entries = {}
+        # Keys not in the manifest file, as an ordered set
+        self.new = {}
+
+    def _parse(self, key):
+        offset, length = self.offsets[key]
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            text = file.read(length)
+        entry = yaml.load(text.decode('utf-8'), Loader=SafeLoader)
+        if not isinstance(entry, dict) or list(entry) != [key]:
+            raise ValueError('Manifest index is inconsistent with {}'.format(self.path))
+        return entry[key]
+
+    def __getitem__(self, key):
+        if key not in self.entries:
+            if key not in self.offsets:
+                raise KeyError(key)
+            self.entries[key] = self._parse(key)
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        if key not in self.offsets:
+            self.new[key] = None
+
+    def __delitem__(self, key):
+        if key not in self.entries and key not in self.offsets:
+            raise KeyError(key)
+        self.entries.pop(key, None)
+        self.offsets.pop(key, None)
+        self.new.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.offsets
+
+    def __iter__(self):
+        for key in list(self.offsets):
+            yield key
+        for key in list(self.new):
+            yield key
+
+    def __len__(self):
+        return len(self.offsets) + len(self.new)
+
+    def loaded(self):
+        """
+        Return number of entries which have been parsed or added
+        """
+        return len(self.entries)
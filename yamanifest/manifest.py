@@ -24,14 +24,80 @@ from six.moves import zip
 
 import os
 import sys
+import json
 import yaml
 import copy
 import subprocess
 import multiprocessing as mp
-from collections import defaultdict
-
-from .hashing import hash, supported_hashes
-from yamanifest.utils import find_files
+from multiprocessing.pool import ThreadPool
+import time
+import threading
+from collections import defaultdict, namedtuple
+from collections.abc import Hashable
+
+from .hashing import (hash_many, binhashes, one_hundred_megabytes, sort_by_cost, treehashes,
+                      tree_blocksize, parse_tree_hash, _binhash_extent)
+from .cache import HashCache
+from . import binformat
+from .lazy import LazyData, load_index
+from yamanifest.utils import find_files, SerialPool
+
+# Use the libyaml C loader and dumper if they are available
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper
+except ImportError:
+    from yaml import SafeLoader
+    CSafeDumper = None
+
+# Formats for manifest files
+fileformats = ['yaml', 'binary']
+
+# Extension of the journal file holding changes not yet written to a manifest
+journal_extension = '.journal'
+
+# Backends available for calculating hashes
+backends = ['auto', 'process', 'thread', 'serial']
+
+# Policies for cascading checks from cheap to expensive hashes
+cascade_policies = ['first', 'confirm']
+
+# Below this total amount of data to hash the cost of using a pool outweighs
+# any benefit, and files are hashed serially
+serial_threshold = 32*1024*1024
+
+# Above this average file size the time is spent in reading and hashing
+# large blocks, which release the GIL, so threads are as effective as processes
+thread_threshold = 1024*1024
+
+def choose_backend(nfiles, sample, numproc):
+    """
+    Return the backend for hashing nfiles files with a pool of numproc
+    workers, given a sample of them as a list of (fullpath, stat, hash
+    functions). Stat may be None, in which case the file is stat'd. Files
+    are hashed serially if the estimated amount of data to read is too
+    small for a pool to be worthwhile, by threads if the files are large,
+    and otherwise by processes
+    """
+    if nfiles <= 1 or numproc <= 1 or len(sample) == 0:
+        return 'serial'
+    nbytes = 0
+    for fullpath, stat, fns in sample:
+        if stat is None:
+            stat = file_stat(fullpath)
+        if stat is None:
+            continue
+        size = stat['size']
+        # binhashes only read the start of a file
+        if all(fn in binhashes for fn in fns):
+            size = min(size, one_hundred_megabytes)
+        nbytes += size
+    mean = nbytes / len(sample)
+    if mean * nfiles < serial_threshold:
+        return 'serial'
+    elif mean >= thread_threshold:
+        return 'thread'
+    else:
+        return 'process'
 
 class HashExists(Exception):
     """Trying to add a hashed value when one already exists"""
@@ -42,6 +108,195 @@ class FilePathNonexistent(Exception):
 class HashNonexistent(Exception):
     """Trying to check a hashed value when there is none"""
 
+def file_stat(path):
+    """
+    Return dict of the stat fields used to decide if a file has changed
+    since it was hashed. Return None if path cannot be stat'd
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return stat_fields(st)
+
+def stat_fields(st):
+    """
+    Return dict of the fields used by file_stat from a stat result
+    """
+    return { 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+             'inode': st.st_ino, 'device': st.st_dev }
+
+# Hash values calculated for a filepath, with metrics of the task: the
+# number of bytes read, the wall and CPU time taken to read and hash them,
+# the time the task waited in the queue and the worker which ran it.
+# Worker is None for values from the hash cache
+HashResult = namedtuple('HashResult', ['path', 'hashes', 'bytes', 'elapsed', 'cputime', 'wait', 'worker'])
+
+# Result of checking a filepath: status is True if the file is correct,
+# computed are the hash values calculated and expected those in the manifest
+CheckResult = namedtuple('CheckResult', ['path', 'status', 'computed', 'expected', 'bytes', 'elapsed'])
+
+# A difference between two manifests: change is 'added', 'removed',
+# 'modified' or 'moved', path is the filepath in the first manifest (None
+# if added) and otherpath in the second (None if removed), and hashes and
+# otherhashes are the hash values in each
+Difference = namedtuple('Difference', ['change', 'path', 'otherpath', 'hashes', 'otherhashes'])
+
+def _copy_entry(entry):
+    """
+    Return a copy of a manifest entry, copying the dicts it contains (such as
+    hashes) but not the values, which are immutable
+    """
+    return { key: dict(value) if isinstance(value, dict) else value for key, value in entry.items() }
+
+def is_decisive(status, condition):
+    """
+    Return True if the status of a single file decides the result of a
+    check with condition (all or any) regardless of the other files
+    """
+    return (condition is all and not status) or (condition is any and status)
+
+def collect_checks(results, hashvals=None, condition=all, failfast=False):
+    """
+    Return the result of a check from a generator of CheckResults, with
+    condition (all or any) applied to their status. Values of hashes which
+    do not match are saved in hashvals if it is a dict. If failfast is True
+    stop at the first result which decides the check, closing results
+    """
+    status = []
+    tmphashvals = defaultdict(dict)
+
+    try:
+        for result in results:
+            status.append(result.status)
+            # Save values which do not match
+            for fn, hashval in result.computed.items():
+                if hashval != result.expected[fn]:
+                    tmphashvals[result.path][fn] = hashval
+            if failfast and is_decisive(result.status, condition):
+                break
+    finally:
+        results.close()
+
+    if hashvals is not None:
+        hashvals.update(tmphashvals)
+
+    return condition(status)
+
+def _hash_task(task):
+    """
+    Calculate hashes for one file in a pool worker. Task is a tuple of
+    filepath, fullpath, hash functions, options for hash_many and the
+    time the task was queued
+    """
+    filepath, fullpath, fns, options, queued = task
+    wait = max(time.time() - queued, 0.)
+    start, cpustart = time.perf_counter(), time.thread_time()
+    hashes = hash_many(fullpath, fns, **options)
+    elapsed, cputime = time.perf_counter() - start, time.thread_time() - cpustart
+    try:
+        nbytes = os.path.getsize(fullpath)
+    except OSError:
+        nbytes = 0
+    if all(hashval is None for hashval in hashes.values()):
+        nbytes = 0
+    elif all(fn in binhashes for fn in fns):
+        nbytes = _binhash_extent(nbytes, one_hundred_megabytes)
+    worker = '{}:{}'.format(os.getpid(), threading.current_thread().name)
+    return HashResult(filepath, hashes, nbytes, elapsed, cputime, wait, worker)
+
+def probe(path, maxheader=65536):
+    """
+    Return the header of the manifest at path, reading only the header
+    and not the entries, or None if path is not a manifest. A YAML file
+    is not a manifest unless its first document, which must be shorter
+    than maxheader bytes, is a header with format yamanifest
+    """
+    header = read_header(path, maxheader)
+    if header is None or header.get('format') != 'yamanifest':
+        return None
+    return header
+
+def read_header(path, maxheader=65536):
+    """
+    Return the header dict of a YAML or binary file with a header and data,
+    such as a manifest, or None if it does not have a header of at most
+    maxheader bytes. The data are not read
+    """
+    try:
+        if binformat.is_binary(path):
+            header = binformat.load_header(path)
+        else:
+            lines = []
+            nbytes = 0
+            with open(path, 'r') as file:
+                for line in file:
+                    if line.startswith('---') and line[3:4] in ('', ' ', '\t', '\r', '\n'):
+                        if len(lines) > 0:
+                            # Start of the second document
+                            break
+                        if line[3:].strip() == '':
+                            # Explicit start of the first document
+                            continue
+                    nbytes += len(line)
+                    if nbytes > maxheader:
+                        return None
+                    lines.append(line)
+                else:
+                    # A manifest has a second document with the entries
+                    return None
+            header = yaml.load(''.join(lines), Loader=SafeLoader)
+    except Exception:
+        return None
+    if not isinstance(header, dict):
+        return None
+    return header
+
+def _libyaml_compatible(key, entry):
+    """
+    Return True if the libyaml dumper output for a manifest entry is identical
+    to the pure python dumper. They differ for keys of 123-128 characters,
+    which python writes as complex keys, and in line folding of double quoted
+    strings, which are used for non-printable and non-ASCII characters
+    """
+    if 123 <= len(key) <= 128:
+        return False
+    stack = [key, entry]
+    while len(stack) > 0:
+        obj = stack.pop()
+        if isinstance(obj, str):
+            if not (obj.isascii() and obj.isprintable()):
+                return False
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return True
+
+def dump_yaml(header, data):
+    """
+    Return YAML text for a manifest header and data. Entries are written with
+    the libyaml dumper when available, except where the output would differ from
+    the pure python dumper, so the output is identical whichever is used
+    """
+    if CSafeDumper is None or len(data) == 0:
+        return yaml.dump_all([header, data], Dumper=yaml.SafeDumper, default_flow_style=False)
+
+    chunks = [ yaml.dump(header, Dumper=yaml.SafeDumper, default_flow_style=False), '---\n' ]
+    run = {}
+    for key in sorted(data):
+        if _libyaml_compatible(key, data[key]):
+            run[key] = data[key]
+        else:
+            if len(run) > 0:
+                chunks.append(yaml.dump(run, Dumper=CSafeDumper, default_flow_style=False))
+                run = {}
+            chunks.append(yaml.dump({key: data[key]}, Dumper=yaml.SafeDumper, default_flow_style=False))
+    if len(run) > 0:
+        chunks.append(yaml.dump(run, Dumper=CSafeDumper, default_flow_style=False))
+    return ''.join(chunks)
+
 class Manifest(object):
     """A manifest object
 
@@ -54,29 +309,143 @@ class Manifest(object):
         """
         Return a Manifest object, initialised with a path
         to the manifest file. Optionally specify default
-        order of hashes to use when checking manifest validity
+        order of hashes to use when checking manifest validity.
+        A persistent hash cache can be used by setting cache to a
+        HashCache object, the path to a cache database, or True to
+        use the default cache location. Hashing uses a pool of numproc
+        workers which is created when first required and reused
+        until close() is called. Set backend to 'process' or 'thread' to
+        use a pool of processes or threads, 'serial' to hash in the
+        calling process, or 'auto' (default) to choose based on the amount
+        of data being hashed. Alternatively pass an existing
+        multiprocessing pool as pool, which is not closed by the manifest.
+        Files are read in blocks of blocksize bytes, by default determined
+        from the filesystem, and memory mapped if read_method is 'mmap'.
+        A file must not be truncated while it is memory mapped.
+        Tree hashes of new files use blocks of treeblocksize bytes hashed
+        by treethreads threads, by default the CPUs divided between the
+        files being hashed at the same time. The manifest file is YAML, or the compact
+        binary format if fileformat is 'binary'. If not specified the
+        format is that of the file when loaded, otherwise it is binary if
+        the path has the binary extension (.yamfb). If journal is True
+        add() and delete() append their changes to a journal file, which
+        is replayed by load() and folded into the manifest by dump().
+        Each function in callbacks is called with the HashResult, including
+        metrics such as bytes read and time taken, of every file hashed
         """
         self.path = path
+        # Index of filepaths by (hashfn, hashval), built when first required
+        self._index = None
+        self._indexed = None
         self.data = {}
         self.header = {}
+        self.cache = None
+        self.pool = None
+        self.backend = 'auto'
+        self.blocksize = None
+        self.read_method = 'read'
+        self.treeblocksize = tree_blocksize
+        self.treethreads = None
+        self.fileformat = None
+        self.journal = False
+        self.callbacks = []
+        self._pools = {}
         try:
             self.numproc = mp.cpu_count()
         except NotImplementedError:
             self.numproc = 1
         for key, val in kwargs.items():
             setattr(self, key, val)
+        if self.fileformat is not None and self.fileformat not in fileformats:
+            raise ValueError('Unknown file format {}, must be one of {}'.format(self.fileformat, fileformats))
+        if self.backend not in backends:
+            raise ValueError('Unknown backend {}, must be one of {}'.format(self.backend, backends))
+        if self.cache is True:
+            self.cache = HashCache()
+        elif isinstance(self.cache, str):
+            self.cache = HashCache(self.cache)
         self.iter = 0
         if hashes is None:
             self.hashes = set(['binhash','md5'])
         else:
             self.hashes = set(hashes)
-        # self.lookup = {}
         # Meta data for the yamanifest file version. This is file type
         # version, not library version. Use update in case extra meta
         # data was defined in arguments
         self.header.update({ 'format':'yamanifest', 'version':1.0 })
 
-            
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Replacing the data invalidates the hash index
+        self._data = data
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shut down the worker pools created by this manifest. New
+        pools will be created if more hashing is required
+        """
+        for pool in self._pools.values():
+            pool.close()
+            pool.join()
+        self._pools = {}
+
+    def _terminate_pool(self, pool):
+        """
+        Stop a pool created by this manifest, abandoning any tasks which
+        have not finished. An injected pool is left running
+        """
+        for backend in list(self._pools):
+            if self._pools[backend] is pool:
+                del self._pools[backend]
+                pool.terminate()
+                pool.join()
+
+    def _get_pool(self, backend):
+        """
+        Return the pool used for hashing with backend, creating it if necessary
+        """
+        if self.pool is not None:
+            return self.pool
+        if backend not in self._pools:
+            if backend == 'process':
+                self._pools[backend] = mp.Pool(processes=self.numproc)
+            elif backend == 'thread':
+                self._pools[backend] = ThreadPool(processes=self.numproc)
+            else:
+                self._pools[backend] = SerialPool()
+        return self._pools[backend]
+
+    def _choose_backend(self, filefns, stats=None, nsample=100):
+        """
+        Choose a backend for hashing the files and hash functions in filefns,
+        based on an estimate of the amount of data to be read. Use stats
+        for the file sizes if available, otherwise stat a sample of the files
+        """
+        if self.backend != 'auto':
+            return self.backend
+        if len(filefns) <= 1 or self.numproc <= 1:
+            return 'serial'
+        filepaths = list(filefns)
+        sample = []
+        for filepath in filepaths[::max(1, len(filepaths)//nsample)]:
+            stat = None
+            if stats is not None:
+                stat = stats.get(filepath)
+            fullpath = self.data[filepath]["fullpath"] if stat is None else None
+            sample.append((fullpath, stat, filefns[filepath]))
+        return choose_backend(len(filepaths), sample, self.numproc)
+
     def __iter__(self):
         """
         Iterator method
@@ -90,46 +459,135 @@ class Manifest(object):
         """
         return len(self.data)
 
-    def load(self):
+    def load(self, lazy=False):
         """
-        Load manifest from YAML file
+        Load manifest from YAML or binary file. If lazy is True only an index of
+        the entries in a YAML manifest is loaded, which is saved in a sidecar
+        file, and entries are parsed when accessed
         """
         try:
-            with open(self.path, 'r') as file:
-                self.header, self.data = yaml.safe_load_all(file)
+            if binformat.is_binary(self.path):
+                self.header, self.data = binformat.load(self.path)
+                fileformat = 'binary'
+            elif lazy:
+                self.header, entries = load_index(self.path)
+                self.data = LazyData(self.path, entries)
+                fileformat = 'yaml'
+            else:
+                with open(self.path, 'r') as file:
+                    self.header, self.data = yaml.load_all(file, Loader=SafeLoader)
+                fileformat = 'yaml'
+            if self.fileformat is None:
+                self.fileformat = fileformat
             if "format" not in self.header:
                 raise ValueError('Not yamanifest format')
             if self.header["format"] != 'yamanifest':
                 raise ValueError('Not yamanifest format: {}'.format(self.header["format"]))
+            self._replay_journal()
         except Exception as e:
             sys.stderr.write('Error parsing yamanifest file: {} :: {}\n'.format(self.path,str(e)))
             raise
-            
-        # self._make_lookup()
 
         # Allow chaining a load to creating a new instance
         return self
         
     def dump(self):
         """
-        Dump manifest from YAML file
+        Dump manifest to YAML or binary file
+        """
+        if isinstance(self.data, LazyData):
+            # Parse all entries before the file they are read from is overwritten
+            self.data = dict(self.data.items())
+        fileformat = self.fileformat
+        if fileformat is None:
+            fileformat = 'binary' if self.path.endswith(binformat.extension) else 'yaml'
+        # Record the number of entries, so it can be found by probe()
+        self.header['entries'] = len(self.data)
+        if fileformat == 'binary':
+            binformat.dump(self.header, self.data, self.path)
+        else:
+            with open(self.path, 'w') as file:
+                file.write(dump_yaml(self.header, self.data))
+        # All changes in the journal are now in the manifest
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
+
+    def compact(self):
+        """
+        Fold the journal into the manifest file. Same as dump()
+        """
+        self.dump()
+
+    def journal_path(self):
+        """
+        Return path of the journal file for this manifest
+        """
+        return self.path + journal_extension
+
+    def _write_journal(self, records):
+        """
+        Append records of changes to the journal
+        """
+        with open(self.journal_path(), 'a') as file:
+            for record in records:
+                file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def _journal_entries(self, filepaths):
+        """
+        Append the current state of filepaths to the journal, as additions
+        or deletions if they are no longer in the manifest
         """
-        with open(self.path, 'w') as file:
-            file.write(yaml.dump_all([self.header, self.data], default_flow_style=False))
+        records = []
+        for filepath in filepaths:
+            if filepath in self.data:
+                records.append(['add', filepath, self.data[filepath]])
+            else:
+                records.append(['delete', filepath])
+        self._write_journal(records)
+
+    def _replay_journal(self):
+        """
+        Apply changes recorded in the journal to the data
+        """
+        try:
+            with open(self.journal_path(), 'r') as file:
+                lines = file.readlines()
+        except (IOError, OSError):
+            return
+        for lineno, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if lineno == len(lines) - 1:
+                    # Incomplete final record from an interrupted write
+                    break
+                raise ValueError('Corrupt journal {} line {}'.format(self.journal_path(), lineno+1))
+            if record[0] == 'add':
+                self.data[record[1]] = record[2]
+            elif record[0] == 'delete':
+                self.data.pop(record[1], None)
 
     def delete(self, filepath):
         """
         Delete item for filepath in manifest
         """
+        current = self._index_current()
+        self._unindex(filepath)
         del(self.data[filepath])
+        if current:
+            self._mark_indexed()
+        if self.journal:
+            self._journal_entries([filepath])
 
-    def add(self, filepaths=None, hashfn=None, force=False, shortcircuit=False, fullpaths=None):
+    def add(self, filepaths=None, hashfn=None, force=False, shortcircuit=False, fullpaths=None, stats=None):
         """
         Add hash value for filepath given a hashing function (hashfn).
         If no filepaths defined, default to all current filepaths, and in
         this way can add a hash to all existing filepaths.
         If there is already a hash value only overwrite if force=True,
-        otherwise raise exception.
+        otherwise raise exception. Optionally pass a dict of stat results
+        for filepaths, e.g. from scanning a directory, which are used
+        rather than stat'ing the files again
         """
 
         if filepaths is None:
@@ -147,8 +605,14 @@ class Manifest(object):
 
         tmpfilepaths = []
         tmpfns = []
+        if stats is None:
+            stats = {}
+        else:
+            stats = { filepath: st if st is None or isinstance(st, dict) else stat_fields(st)
+                      for filepath, st in stats.items() }
 
         results = defaultdict(dict)
+        current = self._index_current()
 
         for (filepath,fullpath) in zip(filepaths,fullpaths):
             
@@ -181,8 +645,14 @@ class Manifest(object):
                     continue
                 tmpfilepaths.append(filepath)
                 tmpfns.append(fn)
+
+        # Stat files before hashing, so a file altered while it is being
+        # hashed will not match the recorded stat
+        for filepath in tmpfilepaths:
+            if filepath not in stats:
+                stats[filepath] = file_stat(self.data[filepath]['fullpath'])
         
-        results = self.calc_hashes(tmpfilepaths, tmpfns)
+        results = self.calc_hashes(tmpfilepaths, tmpfns, stats)
                 
         for filepath in results:
 
@@ -224,11 +694,42 @@ class Manifest(object):
 
             # Only save data to manifest if a hash was successfully generated or
             # there were existing hashes, else delete it
+            self._unindex(filepath)
             if len(hashes) > 0:
                 self.data[filepath]["hashes"] = hashes
+                self._record_stat(filepath, results[filepath], stats[filepath])
+                self._reindex(filepath)
             else:
                 del(self.data[filepath])
 
+        if current:
+            self._mark_indexed()
+
+        if self.journal:
+            self._journal_entries(filepaths)
+
+    def _record_stat(self, filepath, newhashes, stat):
+        """
+        Save stat for filepath if it is valid for all stored hashes: either
+        they were all calculated now, or the file is unchanged since the stat
+        was last recorded. Otherwise remove any stat, as it can no longer be
+        used to verify the stored hashes
+        """
+        entry = self.data[filepath]
+        current = all(newhashes.get(fn) == val for fn, val in entry["hashes"].items())
+        if stat is not None and (current or entry.get('stat') == stat):
+            entry['stat'] = stat
+        else:
+            entry.pop('stat', None)
+
+    def stat_matches(self, filepath):
+        """
+        Return True if the stat recorded for filepath matches the file on disk
+        """
+        if not self.contains(filepath) or 'stat' not in self.data[filepath]:
+            return False
+        return self.data[filepath]['stat'] == file_stat(self.data[filepath]['fullpath'])
+
     def contains(self, filepath):
         """
         Return True if filepath is in manifest
@@ -257,59 +758,191 @@ class Manifest(object):
 
         return hashval
         
-    def calc_hashes(self, filepaths, hashfns):
+    def _tree_blocksize(self, filepath, hashfn):
         """
-        Calculate hash values for a number of filepaths and hash function combinations
+        Return block size for tree hash of filepath. Use the block size of an
+        existing hash value so it is reproducible
         """
-        
-        # print("Spawning pool")
-        pool = mp.Pool(processes=self.numproc) #,maxtasksperchild=50)
+        parsed = parse_tree_hash(self.data[filepath]["hashes"].get(hashfn))
+        if parsed is not None:
+            return parsed[0]
+        return self.treeblocksize
 
-        results = defaultdict(dict)
+    def _hash_options(self, filepath, hashfns, workers=1):
+        """
+        Return keyword arguments for hash_many to calculate hashfns for filepath,
+        in one of workers files being hashed at the same time. Unless treethreads
+        is set the CPUs are divided between the workers for tree hashes
+        """
+        treethreads = self.treethreads
+        if treethreads is None:
+            treethreads = max(1, (os.cpu_count() or 1) // workers)
+        options = { 'method': self.read_method, 'blocksize': self.blocksize,
+                    'treeblocksize': self.treeblocksize, 'treethreads': treethreads }
+        for fn in hashfns:
+            if fn in treehashes:
+                options['treeblocksize'] = self._tree_blocksize(filepath, fn)
+        return options
+
+    def iter_hashes(self, filepaths, hashfns, stats=None):
+        """
+        Calculate hash values for a number of filepaths and hash function
+        combinations, yielding a HashResult for each filepath as soon as
+        its hashes are available, in the order they complete. If there is
+        a hash cache it is consulted before hashing, and updated with the
+        newly calculated values. Optionally pass a dict of file stats to
+        use for the cache lookup
+        """
+
+        tasks = list(zip(filepaths, hashfns))
+
+        cached = defaultdict(dict)
+
+        if self.cache is not None:
+            if stats is None:
+                stats = {}
+            for filepath in filepaths:
+                if filepath not in stats:
+                    stats[filepath] = file_stat(self.data[filepath]["fullpath"])
+            hashvals = self.cache.get_many([(stats[filepath], self.data[filepath]["fullpath"], fn)
+                                            for filepath, fn in tasks])
+            misses = []
+            for (filepath, fn), hashval in zip(tasks, hashvals):
+                if fn in treehashes and hashval is not None:
+                    # Cached tree hash must have the required block size
+                    if parse_tree_hash(hashval)[0] != self._tree_blocksize(filepath, fn):
+                        hashval = None
+                if hashval is None:
+                    misses.append((filepath, fn))
+                else:
+                    cached[filepath][fn] = hashval
+            tasks = misses
+
+        # Group hashing functions by file, so each file is read only once
+        filefns = defaultdict(list)
+        for filepath, fn in tasks:
+            filefns[filepath].append(fn)
+
+        # Files which need no hashing are complete already
+        for filepath in list(cached):
+            if filepath not in filefns:
+                yield self._report(HashResult(filepath, cached.pop(filepath), 0, 0., 0., 0., None))
+
+        if len(filefns) == 0:
+            return
+
+        backend = self._choose_backend(filefns, stats)
+        pool = self._get_pool(backend)
+        # Number of files hashed at the same time
+        workers = 1
+        if self.pool is not None or backend != 'serial':
+            workers = max(1, min(self.numproc, len(filefns)))
+
+        queued = time.time()
+        jobs = [ (filepath, self.data[filepath]["fullpath"], fns, self._hash_options(filepath, fns, workers), queued)
+                 for filepath, fns in filefns.items() ]
+        calculated = []
+        try:
+            for result in pool.imap_unordered(_hash_task, jobs):
+                calculated.append(result)
+                self._report(result)
+                if result.path in cached:
+                    hashes = cached.pop(result.path)
+                    hashes.update(result.hashes)
+                    result = result._replace(hashes=hashes)
+                yield result
+        finally:
+            if len(calculated) < len(jobs):
+                # Results are no longer wanted, so cancel pending tasks
+                self._terminate_pool(pool)
+            # Save whatever was calculated, even if not all results were consumed
+            if self.cache is not None:
+                self.cache.put_many([(stats[result.path], self.data[result.path]["fullpath"], fn, result.hashes[fn])
+                                     for result in calculated for fn in filefns[result.path]
+                                     if result.hashes[fn] is not None])
+
+    def add_callback(self, callback):
+        """
+        Call callback with the HashResult of each file hashed, or found in
+        the hash cache, as it becomes available
+        """
+        self.callbacks.append(callback)
+
+    def _report(self, result):
+        """
+        Pass result to the callbacks, returning it unchanged
+        """
+        for callback in self.callbacks:
+            callback(result)
+        return result
 
-        # print("Queuing jobs")
-        for filepath, fn in zip(filepaths,hashfns):
-            results[filepath][fn] = pool.apply_async(hash, args=(self.data[filepath]["fullpath"], fn))
+    def calc_hashes(self, filepaths, hashfns, stats=None):
+        """
+        Calculate hash values for a number of filepaths and hash function combinations.
+        If there is a hash cache it is consulted before hashing, and updated with
+        the newly calculated values. Optionally pass a dict of file stats to use
+        for the cache lookup
+        """
 
-        pool.close()
-        pool.join()
+        results = defaultdict(dict)
 
-        # print("Retrieving results")
-        for filepath, fn in zip(filepaths,hashfns):
-            # Get result of multiprocessing step. Be careful altering this
-            # loop, as this is saving the result back to the dictionary
-            results[filepath][fn] = results[filepath][fn].get()
+        for result in self.iter_hashes(filepaths, hashfns, stats):
+            results[result.path].update(result.hashes)
 
         return results
 
-    def check_file(self, filepaths, hashfn=None, hashvals=None, shortcircuit=False, condition=all):
+    def check_file(self, filepaths, hashfn=None, hashvals=None, shortcircuit=False, condition=all,
+                   trust_stat=False, cascade=None, failfast=False):
         """
         Check hash value for a filepath given a hashing function (hashfn)
         matches stored hash value. Return values of non-matching hashes
         if hashvals dict supplied. If shortcircuit is True, will return True
-        or False result with first True/False result
+        or False result with first True/False result. If trust_stat is True
+        a filepath whose size, mtime, inode and device match those recorded
+        when it was hashed is considered correct without being rehashed.
+
+        If cascade is set each file is checked with its cheapest hash first,
+        and only escalates to the next most expensive hash if required by
+        the cascade policy:
+            'first': only escalate if the hash cannot be calculated
+            'confirm': also escalate if a binhash matched, until a hash
+                       of the full file contents confirms the match
+        A mismatch always decides the file has changed
+
+        If failfast is True checking stops as soon as the result is decided,
+        by the first incorrect file when condition is all, or the first
+        correct file when condition is any. Pending hashing is cancelled
         """
 
-        if type(filepaths) is str:
-            filepaths = [ filepaths ]
+        if hashvals is not None and type(hashvals) is not dict:
+            print("yamanifest :: manifest :: check_items :: hashvals must be a dict")
+            raise
 
-        status = []
+        results = self.iter_check(filepaths, hashfn=hashfn, shortcircuit=shortcircuit, condition=condition,
+                                  trust_stat=trust_stat, cascade=cascade)
 
-        if hashvals is not None:
-            if type(hashvals) is dict:
-                tmphashvals = defaultdict(dict)
-            else:
-                print("yamanifest :: manifest :: check_items :: hashvals must be a dict")
-                raise
-            
-        results = defaultdict(dict)
+        return collect_checks(results, hashvals, condition, failfast)
 
-        tmpfilepaths = []
-        tmpfns = []
+    def iter_check(self, filepaths, hashfn=None, shortcircuit=False, condition=all,
+                   trust_stat=False, cascade=None):
+        """
+        Check files in the same way as check_file, but yield a CheckResult
+        for each filepath as soon as it is decided, in the order they complete.
+        If filepaths is None all filepaths are checked
+        """
 
-        for filepath in filepaths:
+        if filepaths is None:
+            filepaths = list(self.data.keys())
+        elif type(filepaths) is str:
+            filepaths = [ filepaths ]
 
-            fns = []
+        if cascade is not None and cascade not in cascade_policies:
+            raise ValueError('Unknown cascade policy {}, must be one of {}'.format(cascade, cascade_policies))
+
+        verified = []
+        queue = {}
+
+        for filepath in filepaths:
 
             if self.contains(filepath):
                 hashes = self.data[filepath]["hashes"]
@@ -325,55 +958,94 @@ class Manifest(object):
                 fns = [hashfn,]
             else:
                 fns = hashfn
-                
-            for fn in fns:
-                # Ignore hash test if it does not exist in the manifest. Need this behaviour
-                # so we can cascade hashes which in some cases are incompatible with certain
-                # file types, e.g. nchash
-                if fn in hashes:
-                    tmpfilepaths.append(filepath)
-                    tmpfns.append(fn)
 
-        results = self.calc_hashes(tmpfilepaths, tmpfns)
+            if trust_stat and any(fn in hashes for fn in fns) and self.stat_matches(filepath):
+                verified.append(filepath)
+                continue
 
-        for filepath in filepaths:
+            # Ignore hash test if it does not exist in the manifest. Need this behaviour
+            # so we can cascade hashes which in some cases are incompatible with certain
+            # file types, e.g. nchash
+            fns = [fn for fn in fns if fn in hashes]
+            if cascade is not None:
+                fns = sort_by_cost(fns)
+            queue[filepath] = fns
 
-            if filepath in results:
-                filestatus = []
+        return self._check_rounds(verified, queue, shortcircuit, condition, cascade)
 
-                for fn in results[filepath]:
-                    if fn in self.data[filepath]["hashes"]:
-                        # Get result of multiprocessing step
-                        hashval = results[filepath][fn]
-                        if hashval == self.data[filepath]["hashes"][fn]:
-                            filestatus.append(True)
-                            if shortcircuit:
-                                break
-                            else:
-                                continue
-                        else:
-                            # Save these values if given list in which to return them
-                            if hashvals is not None:
-                                tmphashvals[filepath][fn] = hashval
+    def _check_rounds(self, verified, queue, shortcircuit, condition, cascade):
+        """
+        Generator for iter_check. Without a cascade all hashes for each file
+        are calculated in a single round. With a cascade each round calculates
+        only the next hash for files which have not been decided
+        """
 
-                    # Should only get here if fn does not exist in manifest, or differs in value
-                    filestatus.append(False)
+        for filepath in verified:
+            yield CheckResult(filepath, True, {}, {}, 0, 0.)
 
-                    if shortcircuit:
-                        break
+        computed = defaultdict(dict)
+        nbytes = defaultdict(int)
+        elapsed = defaultdict(float)
 
-                # Only return True for a filepath if there was at least one
-                # True hash. Ensures filepaths with no hash are False and must
-                # be regenerated
-                status.append(condition(filestatus) and len(filestatus)>0)
-            else:
-                # Fall here when hash specified but was not in manifest
-                status.append(False)
+        def decided(filepath, status):
+            hashes = self.data[filepath]["hashes"]
+            return CheckResult(filepath, status, computed[filepath],
+                               { fn: hashes[fn] for fn in computed[filepath] },
+                               nbytes[filepath], elapsed[filepath])
 
-        if hashvals is not None:
-            hashvals.update(tmphashvals)
+        while len(queue) > 0:
 
-        return condition(status)
+            tasks = []
+            for filepath, fns in queue.items():
+                if len(fns) == 0:
+                    # Filepaths with no hash, or no hashes left to try, must be regenerated
+                    yield decided(filepath, False)
+                elif cascade is not None:
+                    tasks.append((filepath, fns.pop(0)))
+                else:
+                    tasks.extend((filepath, fn) for fn in fns)
+
+            nextqueue = {}
+            results = self.iter_hashes([filepath for (filepath, _) in tasks], [fn for (_, fn) in tasks])
+            try:
+                for result in results:
+                    filepath = result.path
+                    computed[filepath].update(result.hashes)
+                    nbytes[filepath] += result.bytes
+                    elapsed[filepath] += result.elapsed
+                    hashes = self.data[filepath]["hashes"]
+
+                    if cascade is None:
+                        filestatus = []
+                        for fn in queue[filepath]:
+                            filestatus.append(result.hashes[fn] == hashes[fn])
+                            if shortcircuit:
+                                break
+                        yield decided(filepath, condition(filestatus))
+                        continue
+
+                    (fn, hashval), = result.hashes.items()
+                    remaining = queue[filepath]
+                    if hashval is None:
+                        # Could not calculate this hash, try the next one
+                        nextqueue[filepath] = remaining
+                    elif hashval == hashes[fn]:
+                        if cascade == 'confirm' and fn in binhashes:
+                            remaining = [ nextfn for nextfn in remaining if nextfn not in binhashes ]
+                        else:
+                            remaining = []
+                        if len(remaining) > 0:
+                            nextqueue[filepath] = remaining
+                        else:
+                            yield decided(filepath, True)
+                    else:
+                        # A mismatch decides the file has changed
+                        yield decided(filepath, False)
+            finally:
+                # Cancel remaining work if the caller stops early
+                results.close()
+
+            queue = nextqueue
 
     def check(self, hashvals=None, **args):
         """
@@ -425,80 +1097,220 @@ class Manifest(object):
         else:
             return NotImplemented
 
-    def find(self, hashfn, hashval):
+    def diff(self, other):
         """
-        Find a hashfn value in a manifest. Return filepath on success, None otherwise
+        Yield a Difference for each entry which differs between this manifest
+        and other, in a single pass over each. Entries in both manifests are
+        modified if their hashes of the file contents differ (or any hash,
+        if they have no content hashes in common). Entries only in this
+        manifest are moved if an entry only in other has any of the same
+        hash values, otherwise removed. The remaining entries only in other
+        are added
         """
+        removed = []
+        for filepath in self:
+            if filepath not in other.data:
+                removed.append(filepath)
+                continue
+            hashes = self.data[filepath]["hashes"]
+            otherhashes = other.data[filepath]["hashes"]
+            fns = [fn for fn in hashes if fn in otherhashes]
+            contentfns = [fn for fn in fns if fn not in binhashes]
+            if len(contentfns) > 0:
+                fns = contentfns
+            if len(fns) == 0 or any(hashes[fn] != otherhashes[fn] for fn in fns):
+                yield Difference('modified', filepath, filepath, hashes, otherhashes)
+
+        # Index entries only in other by hash value to find moved entries
+        added = {}
+        index = defaultdict(list)
+        for filepath in other:
+            if filepath not in self.data:
+                added[filepath] = True
+                for key in other._index_keys(filepath):
+                    index[key].append(filepath)
+
+        for filepath in removed:
+            hashes = self.data[filepath]["hashes"]
+            newpath = None
+            for key in self._index_keys(filepath):
+                candidates = index.get(key)
+                # Discard candidates already matched, so each is only seen once
+                while candidates and not added[candidates[-1]]:
+                    candidates.pop()
+                if candidates:
+                    newpath = candidates.pop()
+                    break
+            if newpath is None:
+                yield Difference('removed', filepath, None, hashes, None)
+            else:
+                added[newpath] = False
+                yield Difference('moved', filepath, newpath, hashes, other.data[newpath]["hashes"])
+
+        for filepath, isadded in added.items():
+            if isadded:
+                yield Difference('added', None, filepath, None, other.data[filepath]["hashes"])
+
+    def _index_keys(self, filepath):
+        """
+        Return (hashfn, hashval) keys of the valid hashes for filepath
+        """
+        keys = []
+        for fn, hashval in self.data[filepath].get("hashes", {}).items():
+            # Ignore values that are blank, as get() treats these as undefined
+            if isinstance(hashval, str) and not hashval.strip():
+                continue
+            if isinstance(hashval, Hashable):
+                keys.append((fn, hashval))
+        return keys
+
+    def _build_index(self):
+        """
+        Build index of filepaths by (hashfn, hashval)
+        """
+        self._index = defaultdict(dict)
         for filepath in self.data:
-            if hashval == self.get(filepath, hashfn) and hashval is not None:
-                return filepath
+            for key in self._index_keys(filepath):
+                self._index[key][filepath] = None
+        self._mark_indexed()
 
-        return None
+    def _mark_indexed(self):
+        """
+        Record that the hash index includes every entry in data
+        """
+        self._indexed = (id(self.data), len(self.data))
 
-        
-    def find_from_lookup(self, hashfn, hashval):
+    def _index_current(self):
         """
-        Find a hashfn value in a manifest. Return filepath on success, None otherwise
+        Return True if the hash index exists and no entries have been added
+        to or removed from data since it was last known to include them all.
+        Only the number of entries is compared, so entries added directly
+        together with the same number removed directly are not detected
         """
-        if (hashfn,hashval) in self.lookup:
-            return self.lookup[(hashfn,hashval)]
-        else:
+        return self._index is not None and self._indexed == (id(self.data), len(self.data))
+
+    def _unindex(self, filepath):
+        """
+        Remove filepath from the hash index
+        """
+        if self._index is None or filepath not in self.data:
+            return
+        for key in self._index_keys(filepath):
+            filepaths = self._index.get(key)
+            if filepaths is not None:
+                filepaths.pop(filepath, None)
+                if len(filepaths) == 0:
+                    del self._index[key]
+
+    def _reindex(self, filepath):
+        """
+        Add the current hashes of filepath to the hash index
+        """
+        if self._index is None:
+            return
+        for key in self._index_keys(filepath):
+            self._index[key][filepath] = None
+
+    def find(self, hashfn, hashval):
+        """
+        Find a hashfn value in a manifest. Return filepath on success, None otherwise.
+        Uses an index of filepaths by hash value, which is built on first use and
+        maintained by add, delete, update and load. The index is rebuilt if
+        data is replaced, if the number of entries in data is changed directly,
+        or if a result is stale. Entries added directly together with the same
+        number removed directly, and hashes changed directly in an existing
+        entry, are not found until the index is rebuilt, e.g. by assigning data
+        """
+        if hashval is None:
             return None
+        if not self._index_current():
+            self._build_index()
+        for attempt in range(2):
+            if not isinstance(hashval, Hashable):
+                return None
+            filepaths = self._index.get((hashfn, hashval))
+            if not filepaths:
+                return None
+            filepath = next(iter(filepaths))
+            if filepath in self.data and self.get(filepath, hashfn) == hashval:
+                return filepath
+            self._build_index()
+        return None
 
-    def _make_lookup(self):
-        for filepath in self:
-            for fn in self.data[filepath]["hashes"]:
-                self._add_lookup(filepath,fn)
-
-    def _add_lookup(self,filepath,hashfn):
-        hashval = self.data[filepath]["hashes"][hashfn]
-        self.lookup[(hashfn,hashval)] = filepath
-
-    def update(self, other, newpath=None):
-        """
-        Add one manifest to another. Optionally replace path in fullpath with new path
-        """
-        mftmp = {}
-        if newpath is not None:
-            # Make a copy so we don't alter other
-            mftmp = copy.deepcopy(other)
-            # Cannot safely iterate over keys as the dict is being changed so iterate
-            # over a precomputed list
-            for filepath in list(other.data.keys()):
-                mftmp.data[os.path.normpath(os.path.join(newpath,os.path.basename(filepath)))] = other.data[filepath]
-                del mftmp.data[filepath]
-        else:
-            mftmp = other
+    def find_from_lookup(self, hashfn, hashval):
+        """
+        Find a hashfn value in a manifest. Return filepath on success, None otherwise.
+        Retained for compatibility, same as find()
+        """
+        return self.find(hashfn, hashval)
 
-        self.data.update(mftmp.data)
+    def update(self, other, newpath=None, rewrite=None):
+        """
+        Add one manifest to another. Optionally replace the directory of each
+        filepath with newpath, or pass a function rewrite which returns the
+        new filepath for each filepath. Entries are copied from other as they
+        are merged, so the manifests do not share them, and other is unchanged
+        """
+        if rewrite is None and newpath is not None:
+            def rewrite(filepath):
+                return os.path.normpath(os.path.join(newpath,os.path.basename(filepath)))
+
+        filepaths = []
+        current = self._index_current()
+        for filepath, entry in other.data.items():
+            if rewrite is not None:
+                filepath = rewrite(filepath)
+            self._unindex(filepath)
+            self.data[filepath] = _copy_entry(entry)
+            self._reindex(filepath)
+            if self.journal:
+                filepaths.append(filepath)
+
+        if current:
+            self._mark_indexed()
+
+        if self.journal:
+            self._journal_entries(filepaths)
 
     def update_matching_hashes(self, other):
         """
         Update (add) hashes from other manifest where a match exists between a common
         hash
         """
+        filepaths = []
         for filepath in self:
             for hashfn in self.data[filepath]["hashes"]:
                 hashval = self.data[filepath]["hashes"][hashfn]
                 newfilepath = other.find(hashfn,hashval)
                 if newfilepath is not None:
                     # Check other hashes are consistent?
+                    self._unindex(filepath)
                     self.data[filepath]["hashes"].update(other.data[newfilepath]["hashes"])
+                    self._reindex(filepath)
+                    filepaths.append(filepath)
                     break
 
+        if self.journal:
+            self._journal_entries(filepaths)
+
     @classmethod
     def find_manifest(cls, dirpath):
         """
         Search a directory path and find first manifest file, return Manifest object else None 
+        Only the header of each file is read until a manifest with entries is found.
+        The number of entries in the header is not used if there is a journal
         """
         for file in find_files(dirpath, ["*.yml","*.yaml"]):
+            header = probe(file)
+            if header is None:
+                continue
+            if header.get('entries') == 0 and not os.path.exists(file + journal_extension):
+                continue
             try:
-                mftmp = cls(file) 
-                mftmp.load()
+                mftmp = cls(file).load()
             except:
-                pass
-            finally:
-                if len(mftmp) > 0:
-                    return mftmp
+                continue
+            if len(mftmp) > 0:
+                return mftmp
 
         return None
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ACCESS-NRI
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+import hashlib
+import os
+import threading
+import zlib
+import multiprocessing as mp
+from six.moves import queue
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+from .manifest import (Manifest, FilePathNonexistent, SafeLoader, dump_yaml, read_header, collect_checks,
+                       choose_backend, stat_fields)
+from . import binformat
+from .lazy import index_extension
+
+# Format of the index of a sharded manifest
+sharded_format = 'yamanifest-sharded'
+
+# Ways of assigning filepaths to shards: by the directory of the filepath,
+# or to one of a number of buckets by a hash of the filepath
+layouts = ['directory', 'hash']
+
+def is_sharded(path):
+    """
+    Return True if path is the index of a sharded manifest
+    """
+    header = read_header(path)
+    return header is not None and header.get('format') == sharded_format
+
+class ShardedManifest(object):
+    """A manifest split into shards, each of which is an ordinary manifest
+    file, listed in an index file. Filepaths are assigned to shards by their
+    directory, or by a hash of the filepath into one of nbuckets buckets.
+
+    Shards are stored in a directory alongside the index, and are only loaded
+    when an operation needs them. Only shards which have been changed are
+    written by dump(). Shard files can be checked independently as manifests.
+
+    The shards share the pools of workers used for hashing, created when
+    first required and shut down by close(). With the 'auto' backend the
+    backend is chosen for each operation from a sample of the files to be
+    hashed (see choose_backend), so small operations do not start a pool.
+    If a pool is passed in it is used by all the shards.
+
+    Attributes:
+        path: path to the index file
+        layout: 'directory' or 'hash'
+        nbuckets: number of buckets for the hash layout
+        index: dict of shard path and number of entries, by shard key
+        shards: dict of loaded shard Manifests, by shard key
+    """
+
+    def __init__(self, path, hashes=None, layout='directory', nbuckets=256, **kwargs):
+        """
+        Return a ShardedManifest with an index at path. Hashes and other
+        keyword arguments are passed to the Manifest of each shard
+        """
+        if layout not in layouts:
+            raise ValueError('Unknown layout {}, must be one of {}'.format(layout, layouts))
+        self.path = path
+        self.hashes = hashes
+        self.layout = layout
+        self.nbuckets = nbuckets
+        self.options = kwargs
+        self.header = { 'format': sharded_format, 'version': 1.0 }
+        self.index = {}
+        self.shards = {}
+        self.dirty = set()
+        self.lazy = False
+        self._pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shut down the worker pools shared by the shards. New pools will be
+        created if more hashing is required
+        """
+        for shard in self.shards.values():
+            shard.close()
+        for pool in self._pools.values():
+            pool.close()
+            pool.join()
+        self._pools = {}
+
+    def _numproc(self):
+        numproc = self.options.get('numproc')
+        if numproc is None:
+            try:
+                numproc = mp.cpu_count()
+            except NotImplementedError:
+                numproc = 1
+        return numproc
+
+    def _choose_backend(self, nfiles, sample):
+        """
+        Return the backend for an operation hashing up to nfiles files, given
+        a sample of them as a list of (fullpath, stat, hash functions)
+        """
+        backend = self.options.get('backend', 'auto')
+        if backend != 'auto':
+            return backend
+        return choose_backend(nfiles, sample, self._numproc())
+
+    def _hashfns(self, hashfn):
+        """
+        Return list of hash functions used by an operation given hashfn,
+        or None if the hash functions of each entry are used
+        """
+        if hashfn is None:
+            return None
+        if type(hashfn) is str:
+            return [hashfn,]
+        return list(hashfn)
+
+    def _sample_entries(self, keys, fns=None, nsample=100, nshards=10):
+        """
+        Return a sample of the entries in the shards with keys, as a list of
+        (fullpath, stat, hash functions), loading at most nshards shards.
+        The hash functions are fns, or those of each entry if fns is None
+        """
+        entries = []
+        for key in keys[::max(1, len(keys)//nshards)]:
+            shard = self.shard(key)
+            if shard is not None:
+                entries.extend(shard.data[filepath] for filepath in shard)
+        return [ (entry['fullpath'], entry.get('stat'), list(entry.get('hashes', {})) if fns is None else fns)
+                 for entry in entries[::max(1, len(entries)//nsample)] ]
+
+    def _get_pool(self, backend):
+        """
+        Return the pool shared by the shards for hashing with backend,
+        creating it if necessary, or None to hash serially
+        """
+        if backend == 'serial':
+            return None
+        if backend not in self._pools:
+            if backend == 'thread':
+                self._pools[backend] = ThreadPool(processes=self._numproc())
+            else:
+                self._pools[backend] = mp.Pool(processes=self._numproc())
+        return self._pools[backend]
+
+    def _hashing_shard(self, key, backend, create=False):
+        """
+        Return the shard with key (see shard) for an operation which may
+        hash files with backend, using the shared pool
+        """
+        shard = self.shard(key, create)
+        if shard is not None and self.options.get('pool') is None:
+            shard.backend = backend
+            shard.pool = self._get_pool(backend)
+        return shard
+
+    def __iter__(self):
+        for key in sorted(self.index):
+            for filepath in self.shard(key):
+                yield filepath
+
+    def __len__(self):
+        return sum(len(self.shards[key]) if key in self.shards else self.index[key]['entries']
+                   for key in self.index)
+
+    def shard_key(self, filepath):
+        """
+        Return key of the shard for filepath
+        """
+        if self.layout == 'directory':
+            return os.path.dirname(filepath)
+        return '{:04x}'.format(zlib.crc32(filepath.encode('utf-8')) % self.nbuckets)
+
+    def _shard_filename(self, key):
+        """
+        Return path of the file for a new shard, relative to the index
+        """
+        if self.layout == 'directory':
+            name = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+        else:
+            name = 'bucket-' + key
+        if self.options.get('fileformat') == 'binary':
+            name += binformat.extension
+        else:
+            name += '.yaml'
+        return os.path.join(os.path.basename(self.path) + '.shards', name)
+
+    def shard_path(self, key):
+        """
+        Return path of the file for the shard with key
+        """
+        return os.path.join(os.path.dirname(self.path), self.index[key]['path'])
+
+    def shard(self, key, create=False):
+        """
+        Return the Manifest for the shard with key, loading it if necessary.
+        If there is no such shard return None, or a new empty shard if
+        create is True
+        """
+        if key in self.shards:
+            return self.shards[key]
+        if key in self.index:
+            shard = Manifest(self.shard_path(key), self.hashes, **self.options)
+            if os.path.exists(shard.path):
+                shard.load(lazy=self.lazy)
+        elif create:
+            self.index[key] = { 'path': self._shard_filename(key), 'entries': 0 }
+            shard = Manifest(self.shard_path(key), self.hashes, **self.options)
+            self.dirty.add(key)
+        else:
+            return None
+        self.shards[key] = shard
+        return shard
+
+    def load(self, lazy=False):
+        """
+        Load the index. Shards are loaded when they are needed, lazily if
+        lazy is True (see Manifest.load)
+        """
+        with open(self.path, 'r') as file:
+            self.header, self.index = yaml.load_all(file, Loader=SafeLoader)
+        if self.header.get('format') != sharded_format:
+            raise ValueError('Not sharded yamanifest format: {}'.format(self.header.get('format')))
+        self.layout = self.header['layout']
+        self.nbuckets = self.header.get('buckets', self.nbuckets)
+        self.lazy = lazy
+        self.shards = {}
+        self.dirty = set()
+        return self
+
+    def dump(self):
+        """
+        Write the shards which have changed, and the index
+        """
+        for key in self.dirty:
+            shard = self.shards[key]
+            if len(shard) == 0:
+                # Remove empty shards
+                for path in [shard.path, shard.path + index_extension, shard.journal_path()]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                del self.index[key]
+                del self.shards[key]
+                continue
+            dirname = os.path.dirname(shard.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            shard.dump()
+            self.index[key]['entries'] = len(shard)
+        self.dirty = set()
+        self.header.update({ 'layout': self.layout, 'buckets': self.nbuckets, 'entries': len(self) })
+        with open(self.path, 'w') as file:
+            file.write(dump_yaml(self.header, self.index))
+
+    def _group(self, filepaths):
+        """
+        Return dict of lists of filepaths by shard key
+        """
+        groups = defaultdict(list)
+        for filepath in filepaths:
+            groups[self.shard_key(filepath)].append(filepath)
+        return groups
+
+    def add(self, filepaths=None, hashfn=None, force=False, shortcircuit=False, fullpaths=None, stats=None):
+        """
+        Add filepaths to their shards. See Manifest.add
+        """
+        fns = self._hashfns(hashfn)
+        if fns is None:
+            fns = list(Manifest(None, self.hashes).hashes)
+
+        if filepaths is None:
+            keys = sorted(self.index)
+            backend = self._choose_backend(len(self), self._sample_entries(keys, fns))
+            for key in keys:
+                self._hashing_shard(key, backend).add(hashfn=hashfn, force=force, shortcircuit=shortcircuit)
+                self.dirty.add(key)
+            return
+
+        if type(filepaths) is str:
+            filepaths = [filepaths,]
+        if fullpaths is None:
+            fullpaths = [None] * len(filepaths)
+        elif type(fullpaths) is str:
+            fullpaths = [fullpaths,]
+        fullpaths = dict(zip(filepaths, fullpaths))
+
+        sample = []
+        for filepath in filepaths[::max(1, len(filepaths)//100)]:
+            stat = None if stats is None else stats.get(filepath)
+            if stat is not None and not isinstance(stat, dict):
+                stat = stat_fields(stat)
+            sample.append((fullpaths[filepath] or os.path.realpath(filepath), stat, fns))
+        backend = self._choose_backend(len(filepaths), sample)
+
+        for key, keyfilepaths in self._group(filepaths).items():
+            keyfullpaths = [fullpaths[filepath] for filepath in keyfilepaths]
+            if all(fullpath is None for fullpath in keyfullpaths):
+                keyfullpaths = None
+            keystats = None
+            if stats is not None:
+                keystats = { filepath: stats[filepath] for filepath in keyfilepaths if filepath in stats }
+            self._hashing_shard(key, backend, create=True).add(keyfilepaths, hashfn=hashfn, force=force,
+                                                               shortcircuit=shortcircuit, fullpaths=keyfullpaths,
+                                                               stats=keystats)
+            self.dirty.add(key)
+
+    def delete(self, filepath):
+        """
+        Delete item for filepath from its shard
+        """
+        key = self.shard_key(filepath)
+        shard = self.shard(key)
+        if shard is None:
+            raise KeyError(filepath)
+        shard.delete(filepath)
+        self.dirty.add(key)
+
+    def contains(self, filepath):
+        shard = self.shard(self.shard_key(filepath))
+        return shard is not None and shard.contains(filepath)
+
+    def get(self, filepath, hashfn):
+        shard = self.shard(self.shard_key(filepath))
+        if shard is None:
+            return None
+        return shard.get(filepath, hashfn)
+
+    def fullpath(self, filepath):
+        shard = self.shard(self.shard_key(filepath))
+        if shard is None:
+            return None
+        return shard.fullpath(filepath)
+
+    def iter_check(self, filepaths=None, threads=1, **args):
+        """
+        Yield a CheckResult for each filepath, checked by its shard (see
+        Manifest.iter_check). If filepaths is None all shards are checked,
+        by threads shards at a time, and results are yielded as each file
+        is checked
+        """
+        if filepaths is None:
+            return self._check_shards(sorted(self.index), threads, args)
+
+        if type(filepaths) is str:
+            filepaths = [ filepaths ]
+        groups = self._group(filepaths)
+        for key, keyfilepaths in groups.items():
+            if self.shard(key) is None:
+                raise FilePathNonexistent('{} does not exist in manifest'.format(keyfilepaths[0]))
+
+        fns = self._hashfns(args.get('hashfn'))
+        sample = []
+        for filepath in filepaths[::max(1, len(filepaths)//100)]:
+            shard = self.shard(self.shard_key(filepath))
+            if shard.contains(filepath):
+                entry = shard.data[filepath]
+                sample.append((entry['fullpath'], entry.get('stat'), list(entry['hashes']) if fns is None else fns))
+        backend = self._choose_backend(len(filepaths), sample)
+
+        checks = [ self._hashing_shard(key, backend).iter_check(keyfilepaths, **args)
+                   for key, keyfilepaths in groups.items() ]
+        return self._chain(checks)
+
+    def _chain(self, checks):
+        """
+        Yield the results of each of checks in turn
+        """
+        try:
+            for check in checks:
+                for result in check:
+                    yield result
+        finally:
+            for check in checks:
+                check.close()
+
+    def _check_shards(self, keys, threads, args):
+        """
+        Generator for iter_check of all shards. With more than one thread
+        results are passed back from the threads checking shards through a
+        queue, and if the generator is closed the threads stop after their
+        next result
+        """
+        backend = self._choose_backend(len(self), self._sample_entries(keys, self._hashfns(args.get('hashfn'))))
+
+        if threads <= 1:
+            for key in keys:
+                check = self._hashing_shard(key, backend).iter_check(None, **args)
+                try:
+                    for result in check:
+                        yield result
+                finally:
+                    check.close()
+            return
+
+        # Create the shared pool before the threads which use it
+        self._get_pool(backend)
+        results = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def check_shard(key):
+            try:
+                if stop.is_set():
+                    return
+                check = self._hashing_shard(key, backend).iter_check(None, **args)
+                try:
+                    for result in check:
+                        results.put(result)
+                        if stop.is_set():
+                            break
+                finally:
+                    check.close()
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(done)
+
+        pool = ThreadPool(threads)
+        try:
+            for key in keys:
+                pool.apply_async(check_shard, (key,))
+            remaining = len(keys)
+            while remaining > 0:
+                result = results.get()
+                if result is done:
+                    remaining -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            stop.set()
+            pool.close()
+            pool.join()
+
+    def check_file(self, filepaths, hashvals=None, condition=all, failfast=False, **args):
+        """
+        Check filepaths in their shards. See Manifest.check_file
+        """
+        results = self.iter_check(filepaths, condition=condition, **args)
+        return collect_checks(results, hashvals, condition, failfast)
+
+    def check(self, hashvals=None, condition=all, failfast=False, threads=1, **args):
+        """
+        Check all shards, threads shards at a time. See Manifest.check
+        """
+        if hashvals is not None:
+            hashvals.clear()
+        results = self.iter_check(None, threads=threads, condition=condition, **args)
+        return collect_checks(results, hashvals, condition, failfast)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2026 ACCESS-NRI
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function, absolute_import
+
+from collections import defaultdict
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values using the nearest rank method,
+    or None if there are no values
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    # Smallest rank with at least p percent of values at or below it
+    rank = int(-(-p * len(values) // 100))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class HashStats(object):
+    """Collects the metrics of hashing tasks and summarises them
+
+    A HashStats object can be passed to Manifest.add_callback, and records
+    the HashResult of each file hashed. Tasks are grouped by the hashing
+    functions calculated together, as a file is read once for all of them.
+
+    Attributes:
+        results: list of HashResults of files which were hashed
+        cached: number of files whose hashes were all in the hash cache
+    """
+
+    def __init__(self):
+        self.results = []
+        self.cached = 0
+
+    def __call__(self, result):
+        if result.worker is None:
+            self.cached += 1
+        else:
+            self.results.append(result)
+
+    def summary(self):
+        """
+        Return dict of summary statistics for each group of hashing
+        functions: number of files, bytes read, throughput in GB/s per
+        worker (bytes divided by time spent hashing), fraction of time
+        spent on the CPU, and 50th and 99th percentile task and queue
+        wait times in seconds
+        """
+        groups = defaultdict(list)
+        for result in self.results:
+            groups['+'.join(sorted(result.hashes))].append(result)
+
+        summary = {}
+        for fns, results in groups.items():
+            nbytes = sum(result.bytes for result in results)
+            elapsed = sum(result.elapsed for result in results)
+            cputime = sum(result.cputime for result in results)
+            latencies = [result.elapsed for result in results]
+            waits = [result.wait for result in results]
+            summary[fns] = {
+                'files': len(results),
+                'bytes': nbytes,
+                'gbps': nbytes / elapsed / 1e9 if elapsed > 0 else None,
+                'cpu_fraction': cputime / elapsed if elapsed > 0 else None,
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'wait_p50': percentile(waits, 50),
+                'wait_p99': percentile(waits, 99),
+                'workers': len(set(result.worker for result in results)),
+            }
+        return summary
+
+    def format(self):
+        """
+        Return summary as text, one line per group of hashing functions
+        """
+        def seconds(value):
+            return '-' if value is None else '{:.4f}s'.format(value)
+
+        lines = []
+        for fns, stats in sorted(self.summary().items()):
+            lines.append('{}: {} files, {:.3f} GB, {} GB/s, cpu {}, p50 {}, p99 {}, wait p50 {}, wait p99 {}, {} workers'.format(
+                fns, stats['files'], stats['bytes'] / 1e9,
+                '-' if stats['gbps'] is None else '{:.3f}'.format(stats['gbps']),
+                '-' if stats['cpu_fraction'] is None else '{:.0%}'.format(stats['cpu_fraction']),
+                seconds(stats['p50']), seconds(stats['p99']),
+                seconds(stats['wait_p50']), seconds(stats['wait_p99']), stats['workers']))
+        if self.cached > 0:
+            lines.append('{} files from hash cache'.format(self.cached))
+        return '\n'.join(lines)
@@ -24,6 +24,7 @@ import os, sys
 import fnmatch
 import functools
 import itertools
+from multiprocessing.pool import ThreadPool
 
 # https://stackoverflow.com/a/25413436
 def find_files(dir_path=None, patterns=None):
@@ -43,3 +44,140 @@ def find_files(dir_path=None, patterns=None):
 
         for file_name in itertools.chain(*map(filter_partial, path_patterns)):
             yield os.path.join(root_dir, file_name)
+
+
+def _matches(relpath, patterns):
+    """
+    Return True if the path relative to the scan root, or its last
+    component, matches any of patterns
+    """
+    name = os.path.basename(relpath)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern) for pattern in patterns)
+
+def _scan_dir(task):
+    """
+    List a directory, returning the files as (path, stat) tuples and the
+    subdirectories to scan, excluding those matching exclude patterns
+    """
+    path, relpath, include, exclude = task
+    files, subdirs = [], []
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except OSError:
+        return files, subdirs
+    for entry in entries:
+        entryrelpath = os.path.join(relpath, entry.name) if relpath else entry.name
+        if exclude and _matches(entryrelpath, exclude):
+            continue
+        try:
+            # Do not follow links to directories, which may form cycles
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, entryrelpath))
+            elif entry.is_file():
+                if include and not _matches(entryrelpath, include):
+                    continue
+                files.append((entry.path, entry.stat()))
+        except OSError:
+            continue
+    return files, subdirs
+
+def scan_files(dir_path, include=None, exclude=None, threads=None):
+    """
+    Returns a generator yielding (path, stat) for all files under a
+    directory, using os.scandir. Subdirectories are listed in parallel by
+    a pool of threads, which also stat the files, so the stat results can
+    be reused rather than stat'ing each file again.
+    :type dir_path: str
+    :type include: [str]
+    :type exclude: [str]
+    :param include: Only yield files matching these patterns. Defaults to all files
+    :param exclude: Skip files and directories matching these patterns
+    :param threads: Number of threads. Defaults to the number of CPUs plus 4, at most 32
+
+    Patterns match either the name of a file or directory, or its path
+    relative to dir_path
+    """
+    if threads is None:
+        threads = min(32, (os.cpu_count() or 1) + 4)
+
+    pool = ThreadPool(threads)
+    try:
+        dirs = [(dir_path, '')]
+        while len(dirs) > 0:
+            nextdirs = []
+            tasks = [(path, relpath, include, exclude) for path, relpath in dirs]
+            for files, subdirs in pool.imap_unordered(_scan_dir, tasks):
+                for path, stat in files:
+                    yield path, stat
+                nextdirs.extend(subdirs)
+            dirs = nextdirs
+    finally:
+        pool.terminate()
+        pool.join()
+
+def parse_size(size):
+    """
+    Convert a size string with an optional K, M, G or T suffix (powers of
+    1024) to a number of bytes
+    :type size: str
+    :rtype : int
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper().rstrip('B').rstrip('I')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+class SerialResult(object):
+    """
+    Result of a function called by SerialPool. Mimics AsyncResult
+    """
+    def __init__(self, func, args, kwds):
+        try:
+            self.value = func(*args, **kwds)
+            self.success = True
+        except Exception as e:
+            self.value = e
+            self.success = False
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self.success
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if not self.success:
+            raise self.value
+        return self.value
+
+class SerialPool(object):
+    """
+    Runs tasks in the calling process, with the same interface as
+    multiprocessing.pool.Pool, so it can be used in place of a pool
+    """
+    def apply(self, func, args=(), kwds={}):
+        return func(*args, **kwds)
+
+    def apply_async(self, func, args=(), kwds={}):
+        return SerialResult(func, args, kwds)
+
+    def map(self, func, iterable, chunksize=None):
+        return list(map(func, iterable))
+
+    def imap(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+    imap_unordered = imap
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
@@ -22,14 +22,62 @@ from __future__ import print_function, absolute_import
 
 import os, sys
 import argparse
+import json
 import yaml
 from yamanifest import manifest as mf
+from yamanifest.cache import HashCache
+from yamanifest.dedup import find_duplicates
+from yamanifest.sharded import ShardedManifest, is_sharded, layouts
+from yamanifest.stats import HashStats
+from yamanifest.hashing import read_methods, tree_blocksize
+from yamanifest.lazy import index_extension
+from yamanifest.utils import parse_size, scan_files
+
+def add_hashing_arguments(parser):
+    """
+    Add options controlling how hashes are calculated to a subcommand parser
+    """
+    parser.add_argument("--backend", help="Hash in a pool of processes or threads, serially, or choose automatically (default)",
+                        choices=mf.backends, default='auto')
+    parser.add_argument("--blocksize", help="Size of blocks read from files, e.g. 4M (default is determined from the filesystem)",
+                        type=parse_size, default=None)
+    parser.add_argument("--tree-blocksize", help="Size of blocks hashed in parallel for new xxh3-tree hashes, e.g. 64M",
+                        type=parse_size, default=tree_blocksize)
+    parser.add_argument("--read-method", help="Read files (default) or memory map them", choices=read_methods, default='read')
+    parser.add_argument("--cache", help="Use a persistent hash cache, optionally specifying the database path",
+                        nargs='?', const=True, default=None, metavar='PATH')
+    parser.add_argument("--cache-size", help="Maximum number of hash values in the cache",
+                        type=int, default=1000000)
+
+def find_add_paths(args):
+    """
+    Return file paths to add, expanding directories if recursive, and dict
+    of the stats of files found in directories
+    """
+    filepaths = []
+    stats = {}
+    # Do not add the manifest, its index and journal, or its shards
+    manifestpath = os.path.abspath(args.name)
+    manifestfiles = set([manifestpath, manifestpath + index_extension, manifestpath + mf.journal_extension])
+    shardsdir = manifestpath + '.shards' + os.sep
+    for path in args.files:
+        if args.recursive and os.path.isdir(path):
+            for filepath, stat in scan_files(path, include=args.include, exclude=args.exclude):
+                abspath = os.path.abspath(filepath)
+                if abspath in manifestfiles or abspath.startswith(shardsdir):
+                    continue
+                filepaths.append(filepath)
+                stats[filepath] = stat
+        else:
+            filepaths.append(path)
+    return filepaths, stats
 
 def parse_args(args):
     """
     Parse arguments given as list (args)
     """
     parser = argparse.ArgumentParser(description="Run yamf on one or more files")
+    parser.add_argument("--stats", help="Print hashing throughput and latency statistics to stderr", action='store_true')
 
     subparsers = parser.add_subparsers(dest='command', title='Subcommands',help='Valid subcommands')
 
@@ -38,6 +86,14 @@ def parse_args(args):
     parser_add.add_argument('-n','--name', default='manifest.yaml', action='store', help='Manifest file name')
     parser_add.add_argument("-f","--force", help="Force overwrite of existing manifest", action='store_true')
     parser_add.add_argument("-s","--hashes", help="Use only these hashing functions", action='append')
+    parser_add.add_argument("-r","--recursive", help="Add all files in directories", action='store_true')
+    parser_add.add_argument("--include", help="Only add files in directories which match this pattern", action='append')
+    parser_add.add_argument("--exclude", help="Do not add files or directories which match this pattern", action='append')
+    parser_add.add_argument("--journal", help="Append changes to a journal rather than rewriting an existing manifest", action='store_true')
+    parser_add.add_argument("--shard-by", help="Create a sharded manifest, with a shard for each directory or hash bucket of filepaths",
+                            choices=layouts)
+    parser_add.add_argument("--buckets", help="Number of shards with --shard-by hash (default 256)", type=int, default=256)
+    add_hashing_arguments(parser_add)
     parser_add.add_argument("files", help="File paths to add to manifest", nargs='+')
 
     # Check sub command
@@ -45,26 +101,143 @@ def parse_args(args):
     parser_check.add_argument('-n','--name', default='manifest.yaml', action='store', help='Manifest file name')
     parser_check.add_argument("-s","--hashes", help="Use only these hashing functions", action='append')
     parser_check.add_argument("-a","--any", help="Return true if any of the hashes match (default is true if all match)", action='store_true')
+    parser_check.add_argument("--cascade", help="Check with the cheapest hash first, only escalating to more expensive hashes if required by the policy",
+                              choices=mf.cascade_policies)
+    parser_check.add_argument("--fail-fast", help="Stop at the first incorrect file (or first correct file with --any)", action='store_true')
+    parser_check.add_argument("--threads", help="Number of shards of a sharded manifest checked at a time (default 1)",
+                              type=int, default=1)
+    parser_check.add_argument("--trust-stat", help="Do not rehash files whose size, mtime, inode and device are unchanged", action='store_true')
+    add_hashing_arguments(parser_check)
     parser_check.add_argument("files", help="Check only these files", nargs='*')
 
+    # Convert sub command
+    parser_convert = subparsers.add_parser('convert', help='Convert manifest between YAML and binary formats')
+    parser_convert.add_argument("--to", help="Output format (default is binary if output has the .yamfb extension, otherwise YAML)",
+                                choices=mf.fileformats)
+    parser_convert.add_argument("input", help="Manifest to convert")
+    parser_convert.add_argument("output", help="Converted manifest file name")
+
+    # Dupes sub command
+    parser_dupes = subparsers.add_parser('dupes', help='Find files with the same contents in manifests')
+    parser_dupes.add_argument("-s","--hash", help="Hashing function used to compare file contents (default md5)", default='md5')
+    parser_dupes.add_argument("--min-size", help="Ignore files smaller than this, e.g. 1M (default 1 byte)",
+                              type=parse_size, default=1)
+    add_hashing_arguments(parser_dupes)
+    parser_dupes.add_argument("manifests", help="Manifests to search", nargs='+')
+
+    # Diff sub command
+    parser_diff = subparsers.add_parser('diff', help='Print differences between two manifests as JSON lines')
+    parser_diff.add_argument("manifest1", help="Original manifest")
+    parser_diff.add_argument("manifest2", help="Manifest to compare")
+
+    # Compact sub command
+    parser_compact = subparsers.add_parser('compact', help='Fold journalled changes into manifest')
+    parser_compact.add_argument('-n','--name', default='manifest.yaml', action='store', help='Manifest file name')
+
     return parser.parse_args(args)
 
 def main(args):
     """
     Main routine. Takes return value from parse.parse_args as input
     """
-    mf1 = mf.Manifest(args.name)
+    if args.command == 'convert':
+        mf1 = mf.Manifest(args.input).load()
+        mf2 = mf.Manifest(args.output, fileformat=args.to)
+        mf2.header, mf2.data = mf1.header, mf1.data
+        mf2.dump()
+        return True
+
+    if args.command == 'diff':
+        mf1 = mf.Manifest(args.manifest1).load()
+        mf2 = mf.Manifest(args.manifest2).load()
+        identical = True
+        for difference in mf1.diff(mf2):
+            identical = False
+            print(json.dumps(difference._asdict(), sort_keys=True))
+        if not identical:
+            sys.exit(1)
+        return True
+
+    if args.command == 'compact':
+        mf.Manifest(args.name).load().compact()
+        return True
+
+    options = hashing_options(args)
+    stats = None
+    if args.stats:
+        stats = HashStats()
+        options['callbacks'] = [stats]
+    try:
+        if args.command == 'dupes':
+            return print_duplicates(args, options)
+        mf1 = open_manifest(args, options)
+        try:
+            return run_command(args, mf1)
+        finally:
+            mf1.close()
+    finally:
+        if stats is not None:
+            print(stats.format(), file=sys.stderr)
+
+def open_manifest(args, options):
+    """
+    Return a Manifest, or a ShardedManifest if the manifest is sharded or
+    a new sharded manifest is requested
+    """
+    if os.path.exists(args.name):
+        if is_sharded(args.name):
+            return ShardedManifest(args.name, **options)
+    elif getattr(args, 'shard_by', None) is not None:
+        return ShardedManifest(args.name, layout=args.shard_by, nbuckets=args.buckets, **options)
+    return mf.Manifest(args.name, **options)
+
+def hashing_options(args):
+    """
+    Return dict of Manifest options set by add_hashing_arguments
+    """
+    cache = None
+    if args.cache is not None:
+        cache = HashCache(None if args.cache is True else args.cache, maxentries=args.cache_size)
+    return dict(cache=cache, backend=args.backend, blocksize=args.blocksize,
+                read_method=args.read_method, treeblocksize=args.tree_blocksize)
+
+def print_duplicates(args, options):
+    """
+    Print groups of files with the same contents in the manifests
+    """
+    manifests = [ mf.Manifest(path).load() for path in args.manifests ]
+    groups = find_duplicates(manifests, hashfn=args.hash, minsize=args.min_size, **options)
+    reclaimable = 0
+    for group in groups:
+        print("{} {} bytes".format(group.hashval, group.size))
+        for path, filepath in group.entries:
+            print("  {} :: {}".format(path, filepath))
+        reclaimable += group.size * (len(group.files) - 1)
+    print("{} groups of duplicate files, {} bytes reclaimable".format(len(groups), reclaimable))
+    return True
+
+def run_command(args, mf1):
+    """
+    Run add or check subcommand on manifest mf1
+    """
     if args.command == 'add':
+        # New manifests must be written in full, and sharded manifests only
+        # rewrite changed shards, so neither are journalled
+        journal = args.journal and os.path.exists(args.name) and not isinstance(mf1, ShardedManifest)
         if os.path.exists(args.name):
-            # If manifest exists load existing hash data
-            mf1.load()
-        mf1.add(args.files,hashfn=args.hashes,force=args.force)
-        mf1.dump()
+            # If manifest exists load existing hash data. Only entries being
+            # added are needed when journalling
+            mf1.load(lazy=journal)
+            mf1.journal = journal
+        filepaths, stats = find_add_paths(args)
+        mf1.add(filepaths,hashfn=args.hashes,force=args.force,stats=stats)
+        if not journal:
+            mf1.dump()
 
     elif args.command == 'check':
-        hashvals = {}
         try:
-            mf1.load()
+            # Only load entries which are checked if files specified
+            mf1.load(lazy=len(args.files) > 0)
         except:
             sys.exit(1)
 
@@ -72,15 +245,33 @@ def main(args):
             condition = any
         else:
             condition = all
-        if mf1.check(hashfn=args.hashes,hashvals=hashvals,condition=condition):
+        # Check all filepaths if none specified
+        filepaths = args.files or None
+        options = dict(hashfn=args.hashes,condition=condition,trust_stat=args.trust_stat,cascade=args.cascade)
+        if isinstance(mf1, ShardedManifest):
+            options['threads'] = args.threads
+        status = []
+        try:
+            results = mf1.iter_check(filepaths, **options)
+        except mf.FilePathNonexistent as e:
+            print("{} :: {}".format(args.name, e))
+            sys.exit(1)
+        # Report each file as soon as it has been checked
+        for result in results:
+            status.append(result.status)
+            print("{} :: {} :: {}".format(args.name, result.path, "correct" if result.status else "incorrect"))
+            for fn, hashval in result.computed.items():
+                if hashval != result.expected[fn]:
+                    print("hashes do not match for {}: fn: {}\n  new {} file {}".format(result.path,fn,hashval,result.expected[fn]))
+            sys.stdout.flush()
+            if args.fail_fast and mf.is_decisive(result.status, condition):
+                results.close()
+                break
+        if condition(status):
             print("{} :: hashes are correct".format(args.name))
             return True
         else:
             print("{} :: hashes are incorrect".format(args.name))
-            print(hashvals)
-            for filepath in hashvals:
-                for fn in hashvals[filepath]:
-                    print("hashes do not match for {}: fn: {}\n  new {} file {}".format(filepath,fn,hashvals[filepath][fn],mf1.data[filepath]["hashes"][fn]))
             sys.exit(1)
 
 